@@ -3,7 +3,7 @@ Functions for annotating the image
 compositions in the COCO format using 
 Pycococreatortools.
 """
-import json
+import multiprocessing
 import numpy as np
 import os
 from pycococreatortools import pycococreatortools
@@ -12,6 +12,8 @@ import fnmatch
 import re
 from tqdm import tqdm
 from PIL import Image
+from functions.coco_writer import CocoWriter
+from functions import compositing
 
 INFO = {
     "description": "Example Dataset",
@@ -55,19 +57,204 @@ def filter_for_annotations(root, files, image_filename):
 
     return files
 
-def annotate(image_dir, annotation_dir,
-            dataset_name=datetime.datetime.utcnow().isoformat(' ')):
-
-    coco_output = {
-        "info": INFO,
-        "licenses": LICENSES,
-        "categories": CATEGORIES,
-        "images":[],
-        "annotations":[]
+# <img>_<class>_<n>.png as written by save_annotation_masks
+ANNOTATION_PATTERN = re.compile(r'^(?P<image>[^_]+)_(?P<object>.+)_(?P<instance>\d+)\.png$',
+                                re.IGNORECASE)
+
+def build_annotation_index(annotation_dir):
+    """
+    Walks the annotation directory once and maps every
+    image to its annotation masks.
+    Output: dict of image name without extension and
+    list of paths to its masks, ordered by instance number
+    """
+    index = {}
+    for root, _, files in os.walk(annotation_dir):
+        for f in files:
+            match = ANNOTATION_PATTERN.match(f)
+            if match is None:
+                continue
+            key = match.group('image').lower()
+            instance = int(match.group('instance'))
+            index.setdefault(key, []).append((instance,
+                                            os.path.join(root, f)))
+    return {key: [path for _, path in sorted(masks)]
+            for key, masks in index.items()}
+
+def annotate_image(image_filename, annotation_files,
+                image_id, segmentation_id):
+    """
+    Creates the COCO records of one image
+    Inputs:
+    image_filename = path to the composed image
+    annotation_files = list of paths to its annotation masks
+    image_id = id of the image
+    segmentation_id = id of the first annotation, every
+                    mask uses up one id
+    Output: image info and list of annotation infos
+    """
+    image = Image.open(image_filename)
+    image_info = pycococreatortools.create_image_info(
+                image_id,
+                os.path.basename(image_filename),
+                image.size)
+
+    annotations = []
+    # go through each annotation
+    for annotation_filename in annotation_files:
+        class_id = category_id(annotation_filename)
+        
+        category_info = {'id':class_id,
+                    'is_crowd':'crowd' in image_filename}
+        
+        binary_mask = np.asarray(
+                Image.open(annotation_filename
+                ).convert('1')
+                ).astype(np.uint8)
+        
+        annotation_info = pycococreatortools.create_annotation_info(
+                segmentation_id, image_id,
+                category_info,
+                binary_mask,
+                image.size,
+                tolerance=2)
+
+        if annotation_info is not None:
+            annotations.append(annotation_info)
+
+        segmentation_id += 1
+
+    return image_info, annotations
+
+def category_id(object_name):
+    """
+    Id of the category whose name is in object_name
+    """
+    return [x['id'] for x in CATEGORIES
+            if x['name'] in object_name][0]
+
+def region_annotation(annotation_id, image_id,
+                    category_info, local_mask,
+                    offset, image_size, tolerance=2):
+    """
+    Same record as pycococreatortools.create_annotation_info
+    but made from a mask cropped to the instance, with a one
+    pixel margin, so only the crop is processed
+    Inputs:
+    local_mask = uint8 0/1 mask of the crop
+    offset = (x, y) of the crop in the image
+    image_size = (width, height) of the image
+    Output: annotation info, None for empty masks
+    """
+    if category_info['is_crowd']:
+        # RLE is defined on the full image
+        width, height = image_size
+        binary_mask = np.zeros((height, width), dtype=np.uint8)
+        mask_h, mask_w = local_mask.shape
+        binary_mask[offset[1]:offset[1]+mask_h,
+                    offset[0]:offset[0]+mask_w] = local_mask
+        return pycococreatortools.create_annotation_info(
+                annotation_id, image_id,
+                category_info, binary_mask,
+                image_size, tolerance=tolerance)
+
+    if not local_mask.any():
+        return None
+    bounding_box, area = compositing.region_box(offset, local_mask)
+    bounding_box = [float(value) for value in bounding_box]
+    x0, y0 = offset
+
+    segmentation = pycococreatortools.binary_mask_to_polygon(local_mask,
+                                                        tolerance)
+    if not segmentation:
+        return None
+    # Back to image coordinates, x and y alternate
+    segmentation = [[point + (x0 if i % 2 == 0 else y0)
+                    for i, point in enumerate(polygon)]
+                    for polygon in segmentation]
+
+    return {
+        "id": annotation_id,
+        "image_id": image_id,
+        "category_id": category_info["id"],
+        "iscrowd": 0,
+        "area": area,
+        "bbox": bounding_box,
+        "segmentation": segmentation,
+        "width": image_size[0],
+        "height": image_size[1],
     }
 
-    image_id = 1
-    segmentation_id = 1
+def inline_annotations(image_filename, image_size,
+                    instance_masks, image_id):
+    """
+    Creates the COCO records of a composed image from the
+    instance masks held in memory, without mask files.
+    The annotation ids are left as None, they are assigned
+    when the records are written
+    Inputs:
+    image_filename = path to the composed image
+    image_size = (width, height) of the image
+    instance_masks = list of (object name, cropped mask,
+                    (x, y) of the crop), see
+                    compositing.instance_regions
+    image_id = id of the image
+    Output: image info and list of annotation infos
+    """
+    image_info = pycococreatortools.create_image_info(
+                image_id,
+                os.path.basename(image_filename),
+                image_size)
+
+    annotations = []
+    for object_name, local_mask, offset in instance_masks:
+        category_info = {'id':category_id(object_name),
+                    'is_crowd':False}
+        annotation_info = region_annotation(None, image_id,
+                category_info,
+                local_mask,
+                offset,
+                image_size,
+                tolerance=2)
+        if annotation_info is not None:
+            annotations.append(annotation_info)
+
+    return image_info, annotations
+
+def open_writer(dataset_name, append=False,
+                output_dir='./Output'):
+    """
+    Opens a streaming CocoWriter for
+    instances_<dataset_name>.json in output_dir
+    """
+    json_path = os.path.join(output_dir,
+                    f'instances_{dataset_name}.json')
+    return CocoWriter(json_path, INFO, LICENSES,
+                    CATEGORIES, append=append)
+
+def annotation_key(image_filename):
+    """
+    Key of the image in the annotation index
+    """
+    return os.path.splitext(
+            os.path.basename(image_filename))[0].lower()
+
+def annotate(image_dir, annotation_dir,
+            dataset_name=datetime.datetime.utcnow().isoformat(' '),
+            append=False):
+    """
+    Annotates the composed images in image_dir with their
+    annotation masks. The records are streamed to
+    ./Output/instances_<dataset_name>.json as they are made.
+    append = bool; add the images to an existing json, the
+            ids continue after the ones already in it
+    """
+    writer = open_writer(dataset_name, append=append)
+    image_id = writer.next_image_id
+    segmentation_id = writer.next_annotation_id
+
+    # image -> masks mapping, built in one pass
+    annotation_index = build_annotation_index(annotation_dir)
 
     # Filter for jpeg images
     for root, _, files in os.walk(image_dir):
@@ -75,46 +262,87 @@ def annotate(image_dir, annotation_dir,
 
         # go through each image
         for image_filename in (tqdm(image_files)):
-            image = Image.open(image_filename)
-            image_info = pycococreatortools.create_image_info(
-                        image_id,
-                        os.path.basename(image_filename),
-                        image.size)
-            coco_output["images"].append(image_info)
-
-            # filter for associated png annotations
-            for root, _, files in os.walk(annotation_dir):
-                annotation_files = filter_for_annotations(root,
-                                files, image_filename)
-                
-                # go through each annotation
-                for annotation_filename in annotation_files:
-                    class_id = [x['id'] for x in CATEGORIES
-                                if x['name'] in annotation_filename][0]
-                    
-                    category_info = {'id':class_id,
-                                'is_crowd':'crowd' in image_filename}
-                    
-                    binary_mask = np.asarray(
-                            Image.open(annotation_filename
-                            ).convert('1')
-                            ).astype(np.uint8)
-                    
-                    annotation_info = pycococreatortools.create_annotation_info(
-                            segmentation_id, image_id,
-                            category_info,
-                            binary_mask,
-                            image.size,
-                            tolerance=2)
-
-                    if annotation_info is not None:
-                        coco_output["annotations"].append(annotation_info)
-
-                    segmentation_id += 1
+            # associated png annotations
+            annotation_files = annotation_index.get(
+                        annotation_key(image_filename), [])
 
+            image_info, annotations = annotate_image(image_filename,
+                                        annotation_files,
+                                        image_id,
+                                        segmentation_id)
+            writer.add_image(image_info)
+            for annotation_info in annotations:
+                writer.add_annotation(annotation_info)
+
+            segmentation_id += len(annotation_files)
             image_id += 1
 
-        json_path = f'./Output/instances_{dataset_name}.json'
-        with open(json_path, 'w') as output_json:
-            json.dump(coco_output, output_json)
-                
\ No newline at end of file
+    writer.close()
+
+def _annotate_shard(shard):
+    """
+    Worker for annotate_parallel. Annotates a shard of
+    (image_filename, annotation_files, image_id,
+    segmentation_id) jobs with pre-assigned ids
+    """
+    images = []
+    annotations = []
+    for image_filename, annotation_files, image_id, segmentation_id in shard:
+        image_info, image_annotations = annotate_image(image_filename,
+                                            annotation_files,
+                                            image_id,
+                                            segmentation_id)
+        images.append(image_info)
+        annotations.extend(image_annotations)
+    return images, annotations
+
+def annotate_parallel(image_dir, annotation_dir,
+            dataset_name=datetime.datetime.utcnow().isoformat(' '),
+            workers=None,
+            shard_size=256,
+            append=False):
+    """
+    Same as annotate but the images are annotated
+    across a process pool. Ids are assigned before the
+    work is split: the images are sorted by path, and
+    every image gets the next image_id and a range of
+    segmentation ids sized by its number of masks. The
+    shards are merged in order, so the ids do not depend
+    on the number of workers.
+    Inputs:
+    workers = int; number of processes, os.cpu_count() if None
+    shard_size = int; number of images per shard
+    append = bool; add the images to an existing json
+    """
+    writer = open_writer(dataset_name, append=append)
+
+    annotation_index = build_annotation_index(annotation_dir)
+
+    image_files = []
+    for root, _, files in os.walk(image_dir):
+        image_files.extend(filter_for_jpeg(root, files))
+    image_files.sort()
+
+    jobs = []
+    segmentation_id = writer.next_annotation_id
+    for image_id, image_filename in enumerate(image_files,
+                                    start=writer.next_image_id):
+        annotation_files = annotation_index.get(
+                    annotation_key(image_filename), [])
+        jobs.append((image_filename, annotation_files,
+                    image_id, segmentation_id))
+        segmentation_id += len(annotation_files)
+
+    shards = [jobs[i:i+shard_size]
+            for i in range(0, len(jobs), shard_size)]
+
+    # imap keeps the order of the shards for the merge
+    with multiprocessing.Pool(workers) as pool:
+        for images, annotations in tqdm(pool.imap(_annotate_shard, shards),
+                                    total=len(shards)):
+            for image_info in images:
+                writer.add_image(image_info)
+            for annotation_info in annotations:
+                writer.add_annotation(annotation_info)
+
+    writer.close()
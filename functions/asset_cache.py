@@ -0,0 +1,69 @@
+"""
+Byte-budgeted LRU cache for decoded images, so that
+assets used in many compositions are decoded once
+"""
+from collections import OrderedDict
+
+
+def image_nbytes(image):
+    """
+    Approximate size in memory of a decoded PIL Image
+    or numpy array
+    """
+    if hasattr(image, 'nbytes'):
+        return image.nbytes
+    width, height = image.size
+    return width * height * len(image.getbands())
+
+
+class AssetCache:
+    def __init__(self, max_bytes: int = 512 * 2**20):
+        """
+        Initializing the cache
+        max_bytes = int; memory budget of the decoded
+                images, least recently used images are
+                dropped when it is exceeded
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, loader):
+        """
+        Returns the cached image for key, calls
+        loader to decode it on a miss
+        Inputs:
+        key = hashable key of the image
+        loader = function without arguments returning
+                the decoded PIL Image
+        """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+
+        self.misses += 1
+        image = loader()
+        size = image_nbytes(image)
+        if size <= self.max_bytes:
+            self._entries[key] = (image, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, dropped) = self._entries.popitem(last=False)
+                self.nbytes -= dropped
+        return image
+
+    def stats(self):
+        """
+        Returns dict of the hit and miss counters
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'nbytes': self.nbytes}
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
@@ -0,0 +1,123 @@
+"""
+In-memory index of the assets used for the image
+compositions: backgrounds, extracted foregrounds and
+their masks. Built with one listing per folder and
+optionally persisted to disk as json.
+"""
+import json
+import os
+import random
+from functions.folder_check import FOLDER_LIST, OUTPUT_FOLDERS
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+class AssetCatalog:
+    def __init__(self, backgrounds: list,
+                foregrounds: dict):
+        """
+        Initializing the catalog
+        backgrounds : list of paths to background images
+        foregrounds : dict of class name and list of
+            (foreground path, mask path) pairs
+        """
+        self.backgrounds = backgrounds
+        self.foregrounds = foregrounds
+
+    @classmethod
+    def build(cls, datafolder: str,
+            efo_directory: str,
+            mask_directory: str = None,
+            classes: list = None):
+        """
+        Indexes the backgrounds and the extracted
+        foregrounds and pairs every foreground with its mask.
+        Foregrounds without a mask are left out.
+        Inputs:
+        datafolder = str; path to the Data folder
+        efo_directory = str; path to the EFObjects folder
+        mask_directory = str; path to the Mask folder, if
+                None the Mask folder next to efo_directory
+        classes = list of classes to index, all subfolders
+                of efo_directory if None
+        """
+        bg_folder = os.path.join(datafolder, FOLDER_LIST[0])
+        backgrounds = [os.path.join(bg_folder, bg)
+                    for bg in sorted(os.listdir(bg_folder))
+                    if bg.lower().endswith(IMAGE_EXTENSIONS)]
+
+        if mask_directory is None:
+            mask_directory = os.path.join(os.path.dirname(efo_directory),
+                                        OUTPUT_FOLDERS[4])
+        if classes is None:
+            classes = sorted(os.listdir(efo_directory))
+
+        foregrounds = {}
+        for obj in classes:
+            fg_point = os.path.join(efo_directory, obj)
+            msk_point = os.path.join(mask_directory, obj)
+            if not os.path.isdir(fg_point) or not os.path.isdir(msk_point):
+                foregrounds[obj] = []
+                continue
+            masks = set(os.listdir(msk_point))
+            foregrounds[obj] = [(os.path.join(fg_point, fg),
+                                os.path.join(msk_point, fg))
+                                for fg in sorted(os.listdir(fg_point))
+                                if fg.endswith('.png') and fg in masks]
+        return cls(backgrounds, foregrounds)
+
+    def save(self, catalog_path: str):
+        """
+        Saves the catalog as json to catalog_path
+        """
+        with open(catalog_path, 'w') as catalog_json:
+            json.dump({'backgrounds': self.backgrounds,
+                    'foregrounds': self.foregrounds},
+                    catalog_json)
+
+    @classmethod
+    def load(cls, catalog_path: str):
+        """
+        Loads a catalog saved with save
+        """
+        with open(catalog_path) as catalog_json:
+            catalog = json.load(catalog_json)
+        foregrounds = {obj: [tuple(pair) for pair in pairs]
+                    for obj, pairs in catalog['foregrounds'].items()}
+        return cls(catalog['backgrounds'], foregrounds)
+
+    @classmethod
+    def load_or_build(cls, catalog_path: str,
+                    datafolder: str,
+                    efo_directory: str,
+                    mask_directory: str = None,
+                    classes: list = None):
+        """
+        Loads the catalog from catalog_path if it exists,
+        otherwise builds it and saves it there. Delete the
+        file to re-index after adding assets.
+        """
+        if catalog_path is not None and os.path.isfile(catalog_path):
+            return cls.load(catalog_path)
+        catalog = cls.build(datafolder, efo_directory,
+                            mask_directory, classes)
+        if catalog_path is not None:
+            catalog.save(catalog_path)
+        return catalog
+
+    def sample_background(self, rng=random):
+        """
+        Returns the path to a random background
+        """
+        return rng.choice(self.backgrounds)
+
+    def sample_foreground(self, obj: str, rng=random):
+        """
+        Returns a random (foreground path, mask path)
+        pair of the class, None if the class has
+        no foregrounds
+        """
+        pairs = self.foregrounds.get(obj)
+        if not pairs:
+            return None
+        return rng.choice(pairs)
@@ -0,0 +1,81 @@
+"""
+Writer stage that encodes and saves outputs on a small
+thread pool, so that encoding and disk writes overlap
+with composing the next image
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+class AsyncWriter:
+    def __init__(self, max_workers: int = 2,
+                max_pending: int = 8):
+        """
+        Initializing the writer
+        max_workers = int; number of writer threads, with 0
+                every task runs right away in the caller
+        max_pending = int; number of tasks that may be queued
+                or running, submit blocks when it is reached so
+                that memory stays bounded
+        """
+        self.max_workers = max_workers
+        self._executor = None
+        if max_workers > 0:
+            self._executor = ThreadPoolExecutor(max_workers,
+                                        thread_name_prefix='sig-writer')
+        self._slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self._futures = set()
+        self._errors = []
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Runs fn(*args, **kwargs) on a writer thread. Errors
+        are raised by the next flush
+        """
+        if self._executor is None:
+            fn(*args, **kwargs)
+            return
+        # Backpressure, wait for a free slot
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        self._collect(done_only=True)
+        self._futures.add(future)
+
+    def _collect(self, done_only: bool):
+        """
+        Drops finished tasks and keeps their errors
+        """
+        pending = set()
+        for future in self._futures:
+            if done_only and not future.done():
+                pending.add(future)
+            elif future.exception() is not None:
+                self._errors.append(future.exception())
+        self._futures = pending
+
+    def flush(self):
+        """
+        Waits for all submitted tasks and raises the
+        first error of a task, if any
+        """
+        wait(self._futures)
+        self._collect(done_only=False)
+        if self._errors:
+            error, self._errors = self._errors[0], []
+            raise error
+
+    def close(self):
+        """
+        Flushes and stops the writer threads
+        """
+        try:
+            self.flush()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
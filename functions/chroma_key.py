@@ -4,8 +4,29 @@ Functions for the chromakey operations
 import cv2
 import numpy as np
 import os
+import time
+import multiprocessing
 from PIL import Image
+from tqdm import tqdm
 import functions.folder_check as fldr_chk
+import functions.cutout as cutout
+
+# Half width of the hue range of the background,
+# OpenCV hues go from 0 to 179
+HUE_WINDOW = 15
+# Part of the width and height used as border
+BORDER = 0.05
+# Every BORDER_STEP-th border pixel is sampled
+BORDER_STEP = 4
+# Saturation and value limits come from this percentile
+# of the background pixels, less the margin, but not
+# below the minimums
+SV_PERCENTILE = 2
+SV_MARGIN = 20
+MIN_SATURATION = 40
+MIN_VALUE = 40
+# Frames per folder used for the key range of a session
+SESSION_FRAMES = 3
 #%%
 def auto_chroma(image_path):
     """
@@ -19,25 +40,104 @@ def auto_chroma(image_path):
     """
     image = cv2.imread(image_path)
     image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    _, c4, _ = image.shape
-    c1 = 0
-    c2 = int(0.05 * c4)
-    c3 = int(c4-c2)
-    # This makes two rectangles on the sides of the image 
-    # to extract the range of the background HSV values
-    roi_1 = image[:, c1:c2]
-    roi_2 = image[:, c3:c4]
-    # Get the range of hue values from roi_1 & roi_2
-    h1, _, _ = roi_1[:, :, 0], roi_1[:, :, 1], roi_1[:, :, 2]
-    h2, _, _ = roi_2[:, :, 0], roi_2[:, :, 1], roi_2[:, :, 2]
-    MedianH = np.median(np.vstack((h1, h2)))
-    #MedianS = np.median(np.vstack((s1,s2)))
-    #MedianV = np.median(np.vstack((v1,v2)))
-    lower = np.array([(MedianH - 15), 80, 80])
-    upper = np.array([(MedianH + 15), 255, 255])
+    return auto_chroma_hsv(image)
+
+
+def auto_chroma_hsv(image):
+    """
+    Same as auto_chroma for an image that is already
+    decoded and converted to HSV
+    Input: HSV image array
+    Output: Upper and lower limits of the HSV values of the
+    image background.
+    """
+    return key_range(border_pixels(image))
+
+
+def border_pixels(image,
+                border : float = BORDER,
+                step : int = BORDER_STEP):
+    """
+    Subsampled HSV pixels of the left, right and top
+    borders of the image, where the background is
+    Output: Nx3 uint8 array
+    """
+    height, width = image.shape[:2]
+    bw = max(int(border*width), 1)
+    bh = max(int(border*height), 1)
+    strips = (image[::step, :bw:step],
+            image[::step, width-bw::step],
+            image[:bh:step, bw:width-bw:step])
+    return np.concatenate([strip.reshape(-1, 3) for strip in strips])
+
+
+def key_range(pixels):
+    """
+    Background range of HSV pixels. The hue is the centre
+    of the HUE_WINDOW wide window holding the most pixels
+    in a 180 bin hue histogram, hues wrap around. The
+    saturation and value limits are percentiles of the
+    pixels in that window.
+    Input: Nx3 array of HSV pixels, see border_pixels
+    Output: Upper and lower limits of the HSV values of the
+    background. The hue limits may be outside 0 to 179,
+    see key_mask
+    """
+    hues = pixels[:, 0].astype(np.int32)
+    hist = np.bincount(hues, minlength=180)[:180]
+    # Sum of the window around every hue
+    padded = np.concatenate((hist[-HUE_WINDOW:], hist, hist[:HUE_WINDOW]))
+    sums = np.convolve(padded, np.ones(2*HUE_WINDOW + 1, np.int64),
+                    mode='valid')
+    peak = int(np.argmax(sums))
+
+    distance = np.abs(hues - peak)
+    distance = np.minimum(distance, 180 - distance)
+    background = pixels[distance <= HUE_WINDOW]
+    low_s, low_v = np.percentile(background[:, 1:], SV_PERCENTILE, axis=0)
+    lower = np.array([peak - HUE_WINDOW,
+                    max(low_s - SV_MARGIN, MIN_SATURATION),
+                    max(low_v - SV_MARGIN, MIN_VALUE)], dtype=np.float64)
+    upper = np.array([peak + HUE_WINDOW, 255, 255], dtype=np.float64)
     return lower, upper
 
 
+def key_mask(hsv, lower, upper):
+    """
+    cv2.inRange for a background range whose hue
+    limits may wrap around 0 or 179
+    Output: mask of the background pixels
+    """
+    if lower[0] >= 0 and upper[0] <= 179:
+        return cv2.inRange(hsv, lower, upper)
+    low_hue, high_hue = lower[0] % 180, upper[0] % 180
+    mask = cv2.inRange(hsv, np.array([low_hue, lower[1], lower[2]]),
+                    np.array([179, upper[1], upper[2]]))
+    wrapped = cv2.inRange(hsv, np.array([0, lower[1], lower[2]]),
+                        np.array([high_hue, upper[1], upper[2]]))
+    return cv2.bitwise_or(mask, wrapped)
+
+
+def session_key_range(img_paths : list,
+                    frames : int = SESSION_FRAMES):
+    """
+    Background range of a batch shot against the same
+    backdrop, from the borders of its first frames. The
+    frames are decoded at a quarter of their size
+    Output: lower and upper limits, None if no frame
+    could be read
+    """
+    pixels = []
+    for img_path in img_paths[:frames]:
+        image = cv2.imread(img_path, cv2.IMREAD_REDUCED_COLOR_4)
+        if image is not None:
+            hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+            pixels.append(border_pixels(hsv, step=1))
+    if not pixels:
+        return None
+    return key_range(np.concatenate(pixels))
+
+
 def get_fg(img_path : str,
             mask_path : str, 
             extracted_fg_folder: str):
@@ -52,38 +152,41 @@ def get_fg(img_path : str,
                                 location for saving
                                 extracted foreground
     """
-    image = Image.open(img_path).convert('RGBA')
+    image = Image.open(img_path).convert('RGB')
     width, height = image.size
     mask = Image.open(mask_path).convert('L')
     mask = mask.resize((width, height))
-    image.putalpha(mask)
     # Creating the filename
     base_name = os.path.basename(mask_path)
     save_path = os.path.join(extracted_fg_folder, base_name)
-    image.save(save_path)
-    # return image
+    # The foreground and the mask are saved cropped
+    # to the object, see cutout.crop_offset
+    cutout.save_cutout(image, mask, save_path, mask_path)
 
 
 def get_mask(img_path : str,
-            mask_folder: str):
+            mask_folder: str,
+            allocator: fldr_chk.IndexAllocator = None):
     """
     Generates the binary mask for the image path
     Input: img_path = string for path to image
             mask_folder = string for path to where mask
                         will be saved
+            allocator = IndexAllocator of mask_folder, pass
+                        one in when saving many masks
     Output: Saves the generated mask to the mask_folder
             and returns string for path to mask
     """
     image = cv2.imread(img_path)
     img_mask = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    lower, upper = auto_chroma(img_path)
     # Generating the mask
-    mask = cv2.inRange(img_mask, lower, upper)
-    mask = cv2.bitwise_not(mask)
+    mask = chroma_mask(img_mask)
     
 	# Saving the mask
-    number = str(fldr_chk.get_num(target_folder=mask_folder,
-                                extension='png'))
+    if allocator is None:
+        allocator = fldr_chk.IndexAllocator(mask_folder, 'png',
+                                            block_size=1)
+    number = str(allocator.next())
     mask_path = os.path.join(mask_folder, number)
     mask_path = f'{mask_path}.png'
     cv2.imwrite(mask_path, mask)
@@ -92,10 +195,154 @@ def get_mask(img_path : str,
 
 def extract_with_chromakey(img_path : str,
             mask_folder : str, 
-            extracted_fg_folder: str):
+            extracted_fg_folder: str,
+            allocator: fldr_chk.IndexAllocator = None):
     """
-    Function which calls the get_mask and get_fg
+    Extracts the foreground and mask of one image,
+    numbered with the allocator. See ChromaEngine for
+    many images
     Inputs: img_path = string for path to image
+            allocator = IndexAllocator of mask_folder
+    """
+    if allocator is None:
+        allocator = fldr_chk.IndexAllocator(mask_folder, 'png',
+                                            block_size=1)
+    number = str(allocator.next())
+    # The image is decoded once, see extract_image
+    extract_image(img_path,
+                os.path.join(extracted_fg_folder, f'{number}.png'),
+                os.path.join(mask_folder, f'{number}.png'))
+
+
+def chroma_mask(hsv, key=None):
+    """
+    Binary mask of the foreground of an HSV image
+    key = (lower, upper) background range, found
+            with auto_chroma_hsv if None
+    """
+    if key is None:
+        key = auto_chroma_hsv(hsv)
+    lower, upper = key
+    return cv2.bitwise_not(key_mask(hsv, lower, upper))
+
+
+def extract_image(img_path : str,
+            fg_path : str,
+            mask_path : str,
+            key=None):
+    """
+    Extracts the foreground of an image with a single
+    decode. The HSV image is made once and used for the
+    background range and the mask, the cropped RGBA
+    cutout is built from the decoded array
+    Inputs: img_path = string of path to image
+            fg_path, mask_path = strings of the paths where
+                        the foreground and mask are saved
+            key = (lower, upper) background range, estimated
+                        for the image if None
+    Output: True if the image could be read
     """
-    mask_path = get_mask(img_path, mask_folder)
-    get_fg(img_path, mask_path, extracted_fg_folder)
\ No newline at end of file
+    image = cv2.imread(img_path)
+    if image is None:
+        return False
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    mask = chroma_mask(hsv, key)
+    cutout.save_cutout(cv2.cvtColor(image, cv2.COLOR_BGR2RGB),
+                    mask, fg_path, mask_path)
+    return True
+
+
+def _extract_job(job):
+    return extract_image(*job)
+
+
+class ChromaEngine:
+    def __init__(self, workers : int = None,
+                chunksize : int = 4,
+                session_key : bool = False):
+        """
+        Chroma key extraction over many images with
+        a process pool
+        workers: number of processes, all cores if None,
+            with 1 the images are extracted in this process
+        chunksize: images handed to a process at a time
+        session_key: treat every source folder as one studio
+            session shot against the same backdrop. Its key range
+            is computed once from its first frames and reused for
+            all its images, also in later runs of the engine.
+            Off by default, every image gets its own range
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.chunksize = chunksize
+        self.session_key = session_key
+        # Key range of every source folder
+        self.key_ranges = {}
+        self.images_per_sec = 0.0
+
+    def run(self, source_folder : str,
+            target_folder : str,
+            mask_folder : str,
+            extensions : tuple = ('.jpg', '.png', '.jpeg', '.bmp')):
+        """
+        Extracts the foregrounds of the images in
+        source_folder, see run_items.
+        Output: number of images processed
+        """
+        items = [(os.path.join(source_folder, file),
+                target_folder, mask_folder)
+                for file in sorted(os.listdir(source_folder))
+                if file.lower().endswith(extensions)]
+        return self.run_items(items)
+
+    def run_items(self, items : list):
+        """
+        Extracts the foregrounds of a list of images that
+        may belong to different classes. The file numbers are
+        reserved up front for every mask folder, so the
+        processes never race on file names.
+        items: list of (image path, target folder, mask folder)
+        Output: number of images processed
+        """
+        counts = {}
+        for _, _, mask_folder in items:
+            counts[mask_folder] = counts.get(mask_folder, 0) + 1
+        numbers = {mask_folder: fldr_chk.IndexAllocator(mask_folder,
+                                                    'png').reserve(count)
+                for mask_folder, count in counts.items()}
+
+        if self.session_key:
+            sessions = {}
+            for img_path, _, _ in items:
+                sessions.setdefault(os.path.dirname(img_path),
+                                    []).append(img_path)
+            for folder, img_paths in sessions.items():
+                if self.key_ranges.get(folder) is None:
+                    self.key_ranges[folder] = session_key_range(img_paths)
+
+        jobs = []
+        for img_path, target_folder, mask_folder in items:
+            number = numbers[mask_folder]
+            numbers[mask_folder] += 1
+            key = None
+            if self.session_key:
+                key = self.key_ranges[os.path.dirname(img_path)]
+            jobs.append((img_path,
+                        os.path.join(target_folder, f'{number}.png'),
+                        os.path.join(mask_folder, f'{number}.png'),
+                        key))
+
+        start = time.perf_counter()
+        if self.workers <= 1:
+            results = [extract_image(*job) for job in tqdm(jobs)]
+        else:
+            with multiprocessing.Pool(self.workers) as pool:
+                results = list(tqdm(pool.imap_unordered(_extract_job, jobs,
+                                                    chunksize=self.chunksize),
+                                total=len(jobs)))
+        processed = sum(results)
+        elapsed = time.perf_counter() - start
+        if elapsed > 0:
+            self.images_per_sec = processed/elapsed
+        print(f"ChromaKey processed {processed} images in {elapsed:.1f}s "
+              f"({self.images_per_sec:.2f} images/sec)")
+        return processed
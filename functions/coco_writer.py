@@ -0,0 +1,193 @@
+"""
+Streaming writer for COCO json files. The image and
+annotation records are appended to part files on disk as
+they are produced, so the dataset is never held in memory,
+and the json is assembled when the writer is closed.
+"""
+import json
+import os
+
+# Prefix of every record in the part files
+SEPARATOR = b', '
+
+
+def _copy_range(src, dst, start, end, chunk_size=2**20):
+    """
+    Copies bytes start to end of the file object src to dst
+    """
+    src.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        chunk = src.read(min(chunk_size, remaining))
+        if not chunk:
+            break
+        dst.write(chunk)
+        remaining -= len(chunk)
+
+
+class CocoWriter:
+    def __init__(self, json_path: str,
+                info: dict,
+                licenses: list,
+                categories: list,
+                append: bool = False):
+        """
+        Initializing the writer
+        json_path = str; path of the instances json
+        info, licenses, categories = COCO header of a new file
+        append = bool; extend json_path if it exists. The ids
+                of the new records continue after the existing
+                ones, see next_image_id and next_annotation_id
+        """
+        self.json_path = json_path
+        self.index_path = f'{json_path}.idx'
+        self.header = {"info": info,
+                    "licenses": licenses,
+                    "categories": categories}
+        self.num_images = 0
+        self.num_annotations = 0
+        self.max_image_id = 0
+        self.max_annotation_id = 0
+        self._base = None
+        if append and os.path.isfile(json_path):
+            self._base = self._read_index()
+            self.max_image_id = self._base['max_image_id']
+            self.max_annotation_id = self._base['max_annotation_id']
+
+        self._images_path = f'{json_path}.images.part'
+        self._annotations_path = f'{json_path}.annotations.part'
+        self._images = open(self._images_path, 'wb')
+        self._annotations = open(self._annotations_path, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def next_image_id(self):
+        return self.max_image_id + 1
+
+    @property
+    def next_annotation_id(self):
+        return self.max_annotation_id + 1
+
+    def _read_index(self):
+        """
+        Reads the byte offsets of the existing json. A json
+        that was not written by CocoWriter, or was changed
+        after its index was written, is loaded and written
+        once more to create the index
+        """
+        index = None
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as index_json:
+                index = json.load(index_json)
+        if index is None or not self._index_matches(index):
+            with open(self.json_path) as coco_json:
+                coco = json.load(coco_json)
+            with CocoWriter(self.json_path, coco["info"],
+                            coco["licenses"],
+                            coco["categories"]) as writer:
+                for image_info in coco["images"]:
+                    writer.add_image(image_info)
+                for annotation_info in coco["annotations"]:
+                    writer.add_annotation(annotation_info)
+            with open(self.index_path) as index_json:
+                index = json.load(index_json)
+        return index
+
+    def _index_matches(self, index: dict):
+        """
+        Checks that the index was written with the json as
+        it is now, by its size and modification time and
+        the brackets that end the image and annotation lists
+        """
+        stat = os.stat(self.json_path)
+        if index.get('json_size') != stat.st_size or \
+                index.get('json_mtime_ns') != stat.st_mtime_ns:
+            return False
+        with open(self.json_path, 'rb') as existing:
+            for offset in (index['images_end'], index['annotations_end']):
+                existing.seek(offset)
+                if existing.read(1) != b']':
+                    return False
+        return True
+
+    def add_image(self, image_info: dict):
+        self._images.write(SEPARATOR + json.dumps(image_info).encode())
+        self.num_images += 1
+        self.max_image_id = max(self.max_image_id, image_info['id'])
+
+    def add_annotation(self, annotation_info: dict):
+        self._annotations.write(SEPARATOR + json.dumps(annotation_info).encode())
+        self.num_annotations += 1
+        self.max_annotation_id = max(self.max_annotation_id,
+                                    annotation_info['id'])
+
+    def _copy_part(self, part_path, dst, records_before):
+        """
+        Copies a part file to dst, without the separator
+        of the first record if there are no records before it
+        """
+        size = os.path.getsize(part_path)
+        start = len(SEPARATOR) if records_before == 0 and size else 0
+        with open(part_path, 'rb') as part:
+            _copy_range(part, dst, start, size)
+
+    def close(self):
+        """
+        Assembles the json from the part files. In append
+        mode the existing records are copied over as bytes
+        and are not parsed or serialized again
+        """
+        if self._images.closed:
+            return
+        self._images.close()
+        self._annotations.close()
+
+        base = self._base
+        old_images = base['num_images'] if base else 0
+        old_annotations = base['num_annotations'] if base else 0
+
+        tmp_path = f'{self.json_path}.tmp'
+        with open(tmp_path, 'wb') as output_json:
+            if base:
+                with open(self.json_path, 'rb') as existing:
+                    _copy_range(existing, output_json,
+                                0, base['images_end'])
+            else:
+                header = json.dumps(self.header)[:-1]
+                output_json.write(f'{header}, "images": ['.encode())
+            self._copy_part(self._images_path, output_json, old_images)
+            images_end = output_json.tell()
+
+            output_json.write(b'], "annotations": [')
+            annotations_start = output_json.tell()
+            if base:
+                with open(self.json_path, 'rb') as existing:
+                    _copy_range(existing, output_json,
+                                base['annotations_start'],
+                                base['annotations_end'])
+            self._copy_part(self._annotations_path, output_json,
+                            old_annotations)
+            annotations_end = output_json.tell()
+            output_json.write(b']}')
+
+        os.replace(tmp_path, self.json_path)
+        os.remove(self._images_path)
+        os.remove(self._annotations_path)
+        # The size and time tell if the json was changed later
+        stat = os.stat(self.json_path)
+        with open(self.index_path, 'w') as index_json:
+            json.dump({'json_size': stat.st_size,
+                    'json_mtime_ns': stat.st_mtime_ns,
+                    'images_end': images_end,
+                    'annotations_start': annotations_start,
+                    'annotations_end': annotations_end,
+                    'num_images': old_images + self.num_images,
+                    'num_annotations': old_annotations + self.num_annotations,
+                    'max_image_id': self.max_image_id,
+                    'max_annotation_id': self.max_annotation_id},
+                    index_json)
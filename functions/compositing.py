@@ -0,0 +1,171 @@
+"""
+NumPy/OpenCV compositing backend for the image composer.
+The scale, rotation and flip of an object are folded into
+one affine warp, the object is alpha-blended into the
+canvas in place and its instance id is written into an
+integer label map in the same pass. Both backends keep
+the label map, the instance masks are cut from it.
+"""
+import cv2
+import numpy as np
+from scipy import ndimage
+
+# The object is written into the label map where
+# its mask is at least this opaque
+ALPHA_THRESHOLD = 128
+
+
+def object_matrix(src_size: tuple,
+                dst_size: tuple,
+                angle: float,
+                flip: bool):
+    """
+    Affine matrix that resizes an object from src_size to
+    dst_size, rotates it counter clockwise by angle degrees
+    about its centre and mirrors it if flip is True. This is
+    the same as the scaled, rotated and flipped functions of
+    the image composer, the corners outside dst_size are cut.
+    Output: 3x3 numpy array
+    """
+    src_w, src_h = src_size
+    dst_w, dst_h = dst_size
+    scale_x = dst_w/src_w
+    scale_y = dst_h/src_h
+    # Pixel centres are kept aligned like in a resize
+    scale = np.array([[scale_x, 0, 0.5*scale_x - 0.5],
+                    [0, scale_y, 0.5*scale_y - 0.5],
+                    [0, 0, 1]])
+    centre = ((dst_w - 1)/2, (dst_h - 1)/2)
+    rotation = np.vstack([cv2.getRotationMatrix2D(centre, angle, 1.0),
+                        [0, 0, 1]])
+    matrix = rotation @ scale
+    if flip:
+        mirror = np.array([[-1, 0, dst_w - 1],
+                        [0, 1, 0],
+                        [0, 0, 1]])
+        matrix = mirror @ matrix
+    return matrix
+
+
+def composite(canvas, label_map, rgba,
+            dst_size: tuple,
+            angle: float,
+            flip: bool,
+            placed_at: tuple,
+            instance_id: int):
+    """
+    Warps the object and blends it into the canvas, only
+    the part of the object that lands on the canvas is warped
+    Inputs:
+    canvas = HxWx3 uint8 array, changed in place
+    label_map = HxW integer array, changed in place
+    rgba = hxwx4 uint8 array of the object, the fourth
+            channel is its mask
+    dst_size = (width, height) of the scaled object
+    angle = rotation in degrees
+    flip = bool for mirroring the object
+    placed_at = (x, y) of the top left corner of the object
+    instance_id = value written in the label map
+    Output: False if the object is outside the canvas
+    """
+    dst_w, dst_h = dst_size
+    x, y = placed_at
+    canvas_h, canvas_w = canvas.shape[:2]
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + dst_w, canvas_w), min(y + dst_h, canvas_h)
+    if x0 >= x1 or y0 >= y1:
+        return False
+
+    # warpAffine only interpolates, so large downscales
+    # are area filtered first to avoid aliasing
+    src_h, src_w = rgba.shape[:2]
+    if src_w > 2*dst_w and src_h > 2*dst_h:
+        rgba = cv2.resize(rgba, (2*dst_w, 2*dst_h),
+                        interpolation=cv2.INTER_AREA)
+        src_h, src_w = rgba.shape[:2]
+
+    matrix = object_matrix((src_w, src_h), dst_size, angle, flip)
+    # Into the coordinates of the region of the canvas
+    matrix[0, 2] += x - x0
+    matrix[1, 2] += y - y0
+    warped = cv2.warpAffine(rgba, matrix[:2], (x1 - x0, y1 - y0),
+                        flags=cv2.INTER_LINEAR,
+                        borderMode=cv2.BORDER_CONSTANT,
+                        borderValue=0)
+
+    alpha = warped[:, :, 3:4].astype(np.float32) * (1/255)
+    roi = canvas[y0:y1, x0:x1]
+    blended = roi*(1 - alpha) + warped[:, :, :3]*alpha + 0.5
+    np.copyto(roi, blended, casting='unsafe')
+
+    label_roi = label_map[y0:y1, x0:x1]
+    label_roi[warped[:, :, 3] >= ALPHA_THRESHOLD] = instance_id
+    return True
+
+
+def paste_label(label_map, mask,
+                placed_at: tuple,
+                instance_id: int):
+    """
+    Writes instance_id into the label map where the
+    mask, placed at placed_at, is opaque. Used by the
+    PIL backend after pasting an object
+    Inputs:
+    label_map = HxW integer array, changed in place
+    mask = PIL Image or array of the transformed mask
+    placed_at = (x, y) of the top left corner of the mask
+    instance_id = value written in the label map
+    """
+    mask = np.asarray(mask)
+    x, y = placed_at
+    mask_h, mask_w = mask.shape[:2]
+    canvas_h, canvas_w = label_map.shape
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + mask_w, canvas_w), min(y + mask_h, canvas_h)
+    if x0 >= x1 or y0 >= y1:
+        return
+    local = mask[y0 - y:y1 - y, x0 - x:x1 - x]
+    label_map[y0:y1, x0:x1][local >= ALPHA_THRESHOLD] = instance_id
+
+
+def instance_regions(label_map, num_instances: int):
+    """
+    Finds every instance of the label map in one labelled
+    pass and cuts out its mask. The masks are cropped to
+    the bounding box of the instance plus a one pixel
+    margin, so later steps only touch the crop. Small
+    specks are removed with a morphological open.
+    Output: list of (instance id, (x, y) of the crop,
+    uint8 0/1 mask of the crop) for the visible instances
+    """
+    canvas_h, canvas_w = label_map.shape
+    kernel = np.ones((3, 3), np.uint8)
+    regions = []
+    found = ndimage.find_objects(label_map, max_label=num_instances)
+    for instance_id, slices in enumerate(found, start=1):
+        if slices is None:
+            continue
+        rows, cols = slices
+        y0, y1 = max(rows.start - 1, 0), min(rows.stop + 1, canvas_h)
+        x0, x1 = max(cols.start - 1, 0), min(cols.stop + 1, canvas_w)
+        local = (label_map[y0:y1, x0:x1] == instance_id).astype(np.uint8)
+        local = cv2.morphologyEx(local, cv2.MORPH_OPEN, kernel)
+        if local.any():
+            regions.append((instance_id, (x0, y0), local))
+    return regions
+
+
+def region_box(offset: tuple, local_mask):
+    """
+    Bounding box and area of an instance from its
+    cropped mask, see instance_regions
+    Output: [x, y, width, height] in the image and
+    the number of pixels of the instance
+    """
+    rows = np.flatnonzero(local_mask.any(axis=1))
+    cols = np.flatnonzero(local_mask.any(axis=0))
+    x0, y0 = offset
+    bbox = [int(x0 + cols[0]), int(y0 + rows[0]),
+            int(cols[-1] - cols[0] + 1),
+            int(rows[-1] - rows[0] + 1)]
+    return bbox, int(np.count_nonzero(local_mask))
@@ -0,0 +1,97 @@
+"""
+Saving of the extracted foregrounds and masks cropped
+to the bounding box of the mask. The position of the crop
+in the source image is kept in a png text chunk.
+"""
+import json
+import cv2
+import numpy as np
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+# Key of the png text chunk with the crop
+CROP_KEY = 'sig_crop'
+# Transparent border kept around the object, so
+# resampling does not clamp at its edges
+CROP_MARGIN = 1
+# Pixels at least this opaque are kept by the crop, the
+# faint noise of unrefined U2Net masks is cut away
+CROP_THRESHOLD = 16
+
+
+def alpha_bbox(mask, margin: int = CROP_MARGIN,
+            threshold: int = CROP_THRESHOLD):
+    """
+    Bounding box of the pixels of the mask that are
+    at least threshold
+    Inputs:
+    mask = HxW uint8 array
+    margin = int; pixels added on every side
+    threshold = int; smallest mask value in the box
+    Output: (x, y, width, height), the whole mask
+    if it is empty
+    """
+    height, width = mask.shape[:2]
+    x, y, box_w, box_h = cv2.boundingRect((mask >= threshold).astype(np.uint8))
+    if box_w == 0 or box_h == 0:
+        return 0, 0, width, height
+    x0, y0 = max(x - margin, 0), max(y - margin, 0)
+    x1 = min(x + box_w + margin, width)
+    y1 = min(y + box_h + margin, height)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def crop_info(bbox: tuple, source_size: tuple):
+    """
+    Png text chunk with the crop box and the
+    (width, height) of the source image
+    """
+    x, y, width, height = bbox
+    info = PngInfo()
+    info.add_text(CROP_KEY, json.dumps({'x': x, 'y': y,
+                                    'width': width,
+                                    'height': height,
+                                    'source_size': list(source_size)}))
+    return info
+
+
+def save_cutout(image, mask,
+                fg_path: str,
+                mask_path: str):
+    """
+    Crops the image and mask to the bounding box of the
+    mask, saves the mask and the foreground with the mask
+    as alpha channel
+    Inputs:
+    image = HxWx3 RGB uint8 array or PIL Image
+    mask = HxW uint8 array or PIL Image, the same size
+    fg_path = str; path of the foreground png
+    mask_path = str; path of the mask png
+    Output: crop box (x, y, width, height)
+    """
+    image = np.asarray(image)[:, :, :3]
+    mask = np.asarray(mask)
+    source_size = (mask.shape[1], mask.shape[0])
+    bbox = alpha_bbox(mask)
+    x, y, width, height = bbox
+    mask = mask[y:y+height, x:x+width]
+    image = image[y:y+height, x:x+width]
+
+    info = crop_info(bbox, source_size)
+    Image.fromarray(mask).save(mask_path, pnginfo=info)
+    Image.fromarray(np.dstack((image, mask))).save(fg_path,
+                                                pnginfo=info)
+    return bbox
+
+
+def crop_offset(path: str):
+    """
+    Reads the crop saved with save_cutout
+    Output: dict with x, y, width, height and
+    source_size, None for uncropped files
+    """
+    with Image.open(path) as image:
+        crop = image.info.get(CROP_KEY)
+    if crop is None:
+        return None
+    return json.loads(crop)
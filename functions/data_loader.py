@@ -8,8 +8,10 @@ import random
 import math
 import matplotlib.pyplot as plt
 from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.dataloader import default_collate
 from torchvision import transforms, utils
 from PIL import Image
+import cv2
 
 #==========================dataset load==========================
 class RescaleT(object):
@@ -266,3 +268,85 @@ class SalObjDataset(Dataset):
 			sample = self.transform(sample)
 
 		return sample
+
+#==========================inference load==========================
+# Mean and std of the rgb channels, as used by ToTensorLab(flag=0)
+IMAGE_MEAN = np.array([0.485,0.456,0.406],dtype=np.float32)
+IMAGE_STD = np.array([0.229,0.224,0.225],dtype=np.float32)
+
+class RescaleInfer(object):
+	"""Resize the uint8 image to output_size x output_size with cv2,
+	without a label. Used in place of RescaleT for inference."""
+	def __init__(self,output_size):
+		assert isinstance(output_size,int)
+		self.output_size = output_size
+
+	def __call__(self,sample):
+		imidx, image = sample['imidx'], sample['image']
+
+		h, w = image.shape[:2]
+		# area filtering when shrinking, like the anti aliasing of transform.resize
+		if h*w > self.output_size*self.output_size:
+			interpolation = cv2.INTER_AREA
+		else:
+			interpolation = cv2.INTER_LINEAR
+		img = cv2.resize(image,(self.output_size,self.output_size),interpolation=interpolation)
+
+		return {'imidx':imidx, 'image':img}
+
+class ToTensorInfer(object):
+	"""Normalize the rgb image in one float32 step and convert it to a
+	CxHxW tensor. Same normalization as ToTensorLab(flag=0)."""
+	def __call__(self, sample):
+
+		imidx, image = sample['imidx'], sample['image']
+
+		tmpImg = image.astype(np.float32)
+		tmpImg *= 1.0/max(float(tmpImg.max()),1e-6)
+		tmpImg -= IMAGE_MEAN
+		tmpImg /= IMAGE_STD
+		tmpImg = np.ascontiguousarray(tmpImg.transpose((2, 0, 1)))
+
+		return {'imidx':torch.from_numpy(imidx), 'image': torch.from_numpy(tmpImg)}
+
+class InferenceDataset(Dataset):
+	"""Dataset for running U2Net on images without labels. Images are
+	decoded with cv2 and no dummy label is made. With return_original the
+	decoded BGR image is returned as 'original' too, so it is not read
+	again for saving the mask. Use collate_inference with it."""
+	def __init__(self,img_name_list,transform=None,return_original=False):
+		self.image_name_list = img_name_list
+		if transform is None:
+			transform = transforms.Compose([RescaleInfer(320),ToTensorInfer()])
+		self.transform = transform
+		self.return_original = return_original
+
+	def __len__(self):
+		return len(self.image_name_list)
+
+	def __getitem__(self,idx):
+
+		image = cv2.imread(self.image_name_list[idx],cv2.IMREAD_COLOR)
+		if image is None:
+			raise IOError(f"Could not read {self.image_name_list[idx]}")
+		original = image
+		image = cv2.cvtColor(image,cv2.COLOR_BGR2RGB)
+		imidx = np.array([idx])
+
+		sample = {'imidx':imidx, 'image':image}
+
+		if self.transform:
+			sample = self.transform(sample)
+		if self.return_original:
+			sample['original'] = original
+
+		return sample
+
+def collate_inference(batch):
+	"""Batches the network inputs and keeps the originals, which differ
+	in size, as a list of arrays. The originals are left out of pinning."""
+	originals = [sample.pop('original') for sample in batch if 'original' in sample]
+	batch = default_collate(batch)
+	if originals:
+		batch['original'] = originals
+	return batch
@@ -2,12 +2,21 @@
 Functions for making and checking the folder tree that the project uses
 """
 import os
+import contextlib
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
 
 # List of Input folders
 FOLDER_LIST= ['Backgrounds', 'Classes']
 # List of Output folders
 OUTPUT_FOLDERS = ['Annotations', 'Composed',
-        'ColouredMasks', 'EFObjects', 'Mask']
+        'ColouredMasks', 'EFObjects', 'Mask', 'Pyramid']
+# Hidden file holding the next free number of a folder
+INDEX_FILE = '.sig_index'
 
 
 def check_for_folders(dir_path, list_to_check):
@@ -65,7 +74,8 @@ def get_num(target_folder : str,
     
     """
     Gets the number of masks already in the target folder to
-    name the next one
+    name the next one. Lists the folder on every call,
+    use IndexAllocator when saving many files
     Input: target_folder = string for path to target folder
             extension = string for file extension to count
     Output: Returns int of the number of files in 
@@ -74,4 +84,129 @@ def get_num(target_folder : str,
     number = [filename for filename in
                  os.listdir(target_folder)
                 if filename.endswith(extension)]
-    return len(number) +1
\ No newline at end of file
+    return len(number) +1
+
+
+@contextlib.contextmanager
+def _locked(path):
+    """
+    Opens path and holds an exclusive lock on it,
+    the lock is shared between processes
+    """
+    with open(path, 'a+') as handle:
+        if fcntl is not None:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        else:
+            handle.seek(0)
+            msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield handle
+        finally:
+            if fcntl is not None:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+            else:
+                handle.seek(0)
+                msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class IndexAllocator:
+    def __init__(self, target_folder : str,
+                extension : str,
+                block_size : int = 64):
+        """
+        Hands out the numbers used as file names in
+        target_folder without listing the folder for
+        every file. The folder is scanned once per
+        allocator, after that the next free number is kept
+        in INDEX_FILE inside the folder. Processes reserve blocks of numbers
+        under a file lock, so several processes can write
+        to the same folder.
+        Input: target_folder = string for path to target folder
+                extension = string for file extension that is
+                    numbered, used for the first scan
+                block_size = int; numbers reserved at a time
+        """
+        self.target_folder = target_folder
+        self.extension = extension
+        self.block_size = block_size
+        self.index_path = os.path.join(target_folder, INDEX_FILE)
+        self._next = 0
+        self._end = 0
+        self._checked = False
+
+    def _scan(self):
+        """
+        First free number based on the numbered files
+        already in the folder
+        """
+        highest = 0
+        for filename in os.listdir(self.target_folder):
+            stem = os.path.splitext(filename)[0]
+            if filename.endswith(self.extension) and stem.isdigit():
+                highest = max(highest, int(stem))
+        return highest + 1
+
+    def _validate(self, stored : int):
+        """
+        Checks the stored number against the folder once,
+        on the first reservation. The outputs may have been
+        cleared since INDEX_FILE was written: the stored
+        number is stale when the folder has no numbered
+        files and was changed after INDEX_FILE. Another
+        process that reserved numbers but has not saved
+        yet does not change the folder, so its numbers
+        are kept.
+        Output: Returns int of the first free number
+        """
+        scanned = self._scan()
+        if scanned > 1 or stored <= scanned:
+            return max(stored, scanned)
+        folder_time = os.stat(self.target_folder).st_mtime_ns
+        index_time = os.stat(self.index_path).st_mtime_ns
+        return scanned if folder_time > index_time else stored
+
+    def reserve(self, count : int):
+        """
+        Reserves count consecutive numbers
+        Output: Returns int of the first reserved number
+        """
+        with _locked(self.index_path) as handle:
+            handle.seek(0)
+            content = handle.read().strip()
+            start = int(content) if content else self._scan()
+            if content and not self._checked:
+                start = self._validate(start)
+            self._checked = True
+            handle.seek(0)
+            handle.truncate()
+            handle.write(str(start + count))
+            handle.flush()
+        return start
+
+    def next(self):
+        """
+        Output: Returns int of the next number to use
+        """
+        if self._next == self._end:
+            self._next = self.reserve(self.block_size)
+            self._end = self._next + self.block_size
+        number = self._next
+        self._next += 1
+        return number
+
+    def close(self):
+        """
+        Gives back the unused part of the current block
+        if no other process reserved numbers after it
+        """
+        if self._next == self._end:
+            return
+        with _locked(self.index_path) as handle:
+            handle.seek(0)
+            content = handle.read().strip()
+            if content and int(content) == self._end:
+                handle.seek(0)
+                handle.truncate()
+                handle.write(str(self._next))
+                handle.flush()
+        self._next = self._end = 0
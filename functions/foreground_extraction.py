@@ -15,6 +15,7 @@ import os
 from tqdm import tqdm
 from functions.folder_check import FOLDER_LIST, OUTPUT_FOLDERS
 import functions.u2net_infer as u2
+import functions.pyramid as pyr
 
 Data = "./Data"
 Output = "./Output"
@@ -22,6 +23,7 @@ Output = "./Output"
 CLASSES_PATH = os.path.join(Data, "Classes")
 EFOBJECTS_PATH = os.path.join(Output, "EFObjects")
 MASK_PATH = os.path.join(Output, "Mask")
+PYRAMID_PATH = os.path.join(Output, "Pyramid")
 
 Extensions = ['.jpg', '.png', '.jpeg', '.bmp']
 
@@ -29,7 +31,15 @@ Extensions = ['.jpg', '.png', '.jpeg', '.bmp']
 class FgExtractor:
     def __init__(self, dir_images: str,
                  extractor: str,
-                 clean_after_extract: bool):
+                 clean_after_extract: bool,
+                 batch_size: int = 8,
+                 num_workers: int = u2.DEFAULT_WORKERS,
+                 session=None,
+                 build_pyramid: bool = True,
+                 global_queue: bool = True,
+                 chroma_workers: int = None,
+                 chroma_session_key: bool = False,
+                 model_type: str = 'u2net'):
         """
         Initializing the foreground extractor
         dir_images : Directory containing the subfolders with the images.
@@ -37,10 +47,36 @@ class FgExtractor:
         extractor : either 'ChromaKey' or 'U2Net'
         clean_after_extract : bool for using CascadePSP network to clean up
             foreground object
+        batch_size : number of images per U2Net forward pass
+        num_workers : number of DataLoader workers decoding the
+            images for U2Net
+        session : u2net_infer.ModelSession to reuse loaded networks,
+            one is created on the first U2Net extraction if None
+        build_pyramid : bool for saving pre-scaled levels of the
+            extracted foregrounds for the image composer
+        global_queue : bool for running U2Net on the images of all
+            subfolders as one stream, the batches are then filled
+            across classes. One subfolder at a time if False
+        chroma_workers : number of processes for ChromaKey,
+            all cores if None
+        chroma_session_key : bool for one ChromaKey range per
+            subfolder shot against the same backdrop, see
+            chroma_key.ChromaEngine
+        model_type : U2Net model of the session, 'u2net', 'u2netp'
+            or 'u2netp_int8' for fast cpu only extraction, see
+            u2net_infer.MODEL_TYPES
         """
         self.dir_images = dir_images
         self.extractor = extractor
         self.clean_after_extract = clean_after_extract
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.session = session
+        self.build_pyramid = build_pyramid
+        self.global_queue = global_queue
+        self.chroma_workers = chroma_workers
+        self.chroma_session_key = chroma_session_key
+        self.model_type = model_type
 
     def print_settings(self):
         print(f"""Path to directory is {self.dir_images}, 
@@ -71,6 +107,33 @@ class FgExtractor:
         fldr_chk.replicate_folder_tree(CLASSES_PATH,
                                        MASK_PATH)
 
+        # Networks are loaded once and shared by all subfolders
+        if self.extractor == "U2Net" and self.session is None:
+            self.session = u2.ModelSession(model_type=self.model_type)
+
+        if self.extractor == "U2Net" and self.global_queue:
+            u2.extract_items_U2(self.extraction_items(),
+                            clean_up_post=self.clean_after_extract,
+                            batch_size=self.batch_size,
+                            num_workers=self.num_workers,
+                            session=self.session)
+            self.finish_extraction()
+            return
+
+        if self.extractor == "ChromaKey":
+            engine = chr_key.ChromaEngine(workers=self.chroma_workers,
+                                        session_key=self.chroma_session_key)
+            if self.global_queue:
+                engine.run_items(self.extraction_items())
+            else:
+                for subfolder in tqdm(os.listdir(CLASSES_PATH)):
+                    engine.run(os.path.join(CLASSES_PATH, subfolder),
+                            os.path.join(EFOBJECTS_PATH, subfolder),
+                            os.path.join(MASK_PATH, subfolder),
+                            extensions=tuple(Extensions))
+            self.finish_extraction()
+            return
+
         # The folders are in place. Now to go through them
         # and extract the fg objects from images
         for subfolder in tqdm(os.listdir(CLASSES_PATH)):
@@ -87,14 +150,41 @@ class FgExtractor:
                 u2.extract_foregrounds_U2(source_folder=cls_subfldr,
                                         target_folder=efo_subfldr,
                                         mask_folder=msk_subfldr,
-                                        clean_up_post=self.clean_after_extract)
-
-            elif self.extractor == "ChromaKey":
-                for file in tqdm(os.listdir(cls_subfldr)):
-                    if file.endswith(tuple(Extensions)):
-                        img_path = os.path.join(cls_subfldr,
-                                    file)
-                        chr_key.extract_with_chromakey(img_path,
-                                mask_folder=msk_subfldr,
-                                extracted_fg_folder=efo_subfldr)          
+                                        clean_up_post=self.clean_after_extract,
+                                        batch_size=self.batch_size,
+                                        num_workers=self.num_workers,
+                                        session=self.session)
+
+        self.finish_extraction()
+
+    def extraction_items(self):
+        """
+        Images of all class subfolders with the folders
+        their outputs go to
+        Output: list of (image path, EFObjects subfolder,
+        Mask subfolder)
+        """
+        items = []
+        for subfolder in sorted(os.listdir(CLASSES_PATH)):
+            cls_subfldr = os.path.join(CLASSES_PATH, subfolder)
+            if not os.path.isdir(cls_subfldr):
+                continue
+            efo_subfldr = os.path.join(EFOBJECTS_PATH, subfolder)
+            msk_subfldr = os.path.join(MASK_PATH, subfolder)
+            for file in sorted(os.listdir(cls_subfldr)):
+                if file.lower().endswith(tuple(Extensions)):
+                    items.append((os.path.join(cls_subfldr, file),
+                                efo_subfldr,
+                                msk_subfldr))
+        return items
+
+    def finish_extraction(self):
+        """
+        Steps after all foregrounds are extracted
+        """
+        # Pre-scaled foregrounds for the image composer
+        if self.build_pyramid:
+            pyr.build_pyramids(EFOBJECTS_PATH,
+                            mask_directory=MASK_PATH,
+                            pyramid_directory=PYRAMID_PATH)
 # %%
@@ -1,14 +1,34 @@
 import cv2
 from PIL import Image, ImageOps
 from tqdm import tqdm
-from functions.folder_check import FOLDER_LIST, OUTPUT_FOLDERS
+from functions.folder_check import OUTPUT_FOLDERS
 import os
 from functions import folder_check as fldr_chk
+from functions.asset_catalog import AssetCatalog
+from functions.asset_cache import AssetCache
+from functions import annotator as annot
+from functions import compositing
+from functions import pyramid
+from functions.shards import ShardWriter
+from functions.async_writer import AsyncWriter
 import random
 import math
+import multiprocessing
 import numpy as np
 
 OUTPUT_EXTENSION = '.jpg'
+# Annotation modes: 'masks' saves one png per instance for
+# annotator.annotate, 'inline' creates the COCO records while composing
+ANNOTATION_MODES = ('masks', 'inline')
+# Compositing backends: 'pil' pastes with PIL, 'numpy' warps
+# and blends with NumPy/OpenCV, see functions.compositing
+BACKENDS = ('pil', 'numpy')
+# Output formats: 'files' saves an image, coloured mask and annotation
+# masks per composition, 'shards' writes tar shards, see functions.shards
+OUTPUT_FORMATS = ('files', 'shards')
+# Compositions per task of the parallel compose, in the
+# shards mode a task is one shard of shard_size
+COMPOSE_CHUNK = 64
 RED = 128
 BLUE = 200
 
@@ -22,7 +42,65 @@ class ImgComposer:
                 output_directory:str,
                 efo_directory:str,
                 include_negative_examples=[],
-                datafolder = './Data'):
+                datafolder = './Data',
+                catalog: AssetCatalog = None,
+                catalog_path: str = None,
+                cache_bytes: int = 512 * 2**20,
+                annotation_mode: str = 'masks',
+                dataset_name: str = 'composed',
+                backend: str = 'pil',
+                output_format: str = 'files',
+                shard_size: int = 1000,
+                shard_directory: str = None,
+                io_threads: int = 2,
+                io_queue: int = 8,
+                pyramid_directory: str = None):
+        """
+        Initializing the image composer
+        resolution = tuple; (width, height) of the compositions
+        classes_to_include = list of classes to compose
+        num_of_images = int; number of images to compose
+        max_objects_in_image = int; maximum objects per image
+        output_directory = str; path to the Composed folder
+        efo_directory = str; path to the EFObjects folder
+        catalog = AssetCatalog to sample the assets from,
+                built on the first compose if None
+        catalog_path = str; path where the catalog is
+                persisted, it is loaded from there if it exists
+        cache_bytes = int; memory budget for decoded assets,
+                0 disables the cache. Each worker process
+                has its own cache
+        annotation_mode = str; 'masks' saves the annotation
+                masks, 'inline' streams the COCO annotations of
+                the composed images to instances_<dataset_name>.json
+                without the annotation masks. The json is appended
+                to, like the Composed folder
+        dataset_name = str; name of the inline COCO json
+        backend = str; 'pil' or 'numpy' compositing
+        output_format = str; 'files' or 'shards'. Shards hold
+                the image, the uint16 label map and the metadata
+                of every composition
+        shard_size = int; compositions per shard
+        shard_directory = str; folder of the shards, the
+                Shards folder next to output_directory if None
+        io_threads = int; threads that encode and save the
+                outputs while the next image is composed, with 0
+                the outputs are saved right away. Shards are
+                written in order by the composing thread
+        io_queue = int; outputs that may wait to be saved,
+                compose blocks when it is reached
+        pyramid_directory = str; folder of the pre-scaled
+                foregrounds, the Pyramid folder next to
+                efo_directory if None. Objects are resized from
+                the nearest larger level, or from the full
+                resolution if they have no pyramid
+        """
+        if annotation_mode not in ANNOTATION_MODES:
+            raise ValueError(f"annotation_mode should be one of {ANNOTATION_MODES}")
+        if backend not in BACKENDS:
+            raise ValueError(f"backend should be one of {BACKENDS}")
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"output_format should be one of {OUTPUT_FORMATS}")
         self.classes_to_include = classes_to_include
         self.include_negative_examples = include_negative_examples
         self.num_of_images = num_of_images
@@ -31,88 +109,515 @@ class ImgComposer:
         self.efo_directory = efo_directory
         self.resolution = resolution # (width, height)
         self.datafolder = datafolder
-    
-    def compose(self):
-        for imgno in tqdm(range(self.num_of_images)):
-            
-            img_number = str(fldr_chk.get_num(self.output_directory,
-                                        OUTPUT_EXTENSION))
-            final_path = os.path.join(self.output_directory,
-                                img_number)
-            img_name = f"{final_path}.jpg"
-            
-            # Coloured annotation mask
-            output_dir = os.path.dirname(self.output_directory)
-            cm_path = os.path.join(output_dir,
-                                    OUTPUT_FOLDERS[2],
-                                    img_number)
-            cm_name = f"{cm_path}.png"
-
-            # Number of objects to add in the image
-            NumObjects = random.randrange(1, 
-                        self.max_objects_in_images+1)
-
-            # list of integer values for green
-            # for objects in the range of 
-            # 0 to 255
-            greenlist = list(range(1, 255,
-                        int(255/NumObjects)))
-            
-            Num = 0
-            greenval_and_obj = {}
-
-            while Num != NumObjects:
-                classinstance = random.choice(self.classes_to_include)
-                greenval_and_obj[greenlist[Num]] = classinstance
-                Num += 1
-            
-            # Background image
-            bg_folder = os.path.join(self.datafolder,(FOLDER_LIST[0]))
-            random_bg = random.choice(os.listdir(bg_folder))
-            bg_path = os.path.join(bg_folder, random_bg)
+        self.catalog = catalog
+        self.catalog_path = catalog_path
+        self.cache_bytes = cache_bytes
+        self._cache = None
+        self.annotation_mode = annotation_mode
+        self.dataset_name = dataset_name
+        self.backend = backend
+        self.output_format = output_format
+        self.shard_size = shard_size
+        if shard_directory is None:
+            shard_directory = os.path.join(os.path.dirname(output_directory),
+                                        'Shards')
+        self.shard_directory = shard_directory
+        self._shard_writer = None
+        self.io_threads = io_threads
+        self.io_queue = io_queue
+        self._io_writer = None
+        # Base seed of the random streams, set by compose
+        self.seed = None
+        if pyramid_directory is None:
+            pyramid_directory = os.path.join(os.path.dirname(efo_directory),
+                                        OUTPUT_FOLDERS[5])
+        self.pyramid_directory = pyramid_directory
+        self._levels = {}
+
+    def __getstate__(self):
+        # Workers start with an empty cache instead of
+        # a pickled copy of this one
+        state = self.__dict__.copy()
+        state['_cache'] = None
+        state['_shard_writer'] = None
+        state['_io_writer'] = None
+        return state
+
+    def get_cache(self):
+        """
+        Returns the cache of decoded assets
+        """
+        if self._cache is None:
+            self._cache = AssetCache(self.cache_bytes)
+        return self._cache
+
+    def get_shard_writer(self):
+        """
+        Returns the shard writer of this process
+        """
+        if self._shard_writer is None:
+            self._shard_writer = ShardWriter(self.shard_directory,
+                                            self.shard_size)
+        return self._shard_writer
+
+    def get_io_writer(self):
+        """
+        Returns the writer stage of this process
+        """
+        if self._io_writer is None:
+            self._io_writer = AsyncWriter(self.io_threads,
+                                        self.io_queue)
+        return self._io_writer
+
+    def finish_outputs(self):
+        """
+        Waits until all outputs are saved and closes
+        the last, partly filled, shard
+        """
+        try:
+            if self._io_writer is not None:
+                self._io_writer.close()
+        finally:
+            self._io_writer = None
+            if self._shard_writer is not None:
+                self._shard_writer.close()
+                self._shard_writer = None
+
+    def load_background(self, bg_path: str):
+        """
+        Returns the background resized to the resolution.
+        The resized background is cached, a copy is
+        returned since the objects are pasted on it
+        """
+        def loader():
             background = Image.open(bg_path)
-            background = background.resize(self.resolution,
+            return background.resize(self.resolution,
                             Image.ANTIALIAS)
-            
-            # Black image for binary mask
-            bin_mask = Image.new('RGBA',
-                        background.size,
-                        color='black')
-            
-            # TODO: Adding negative examples
-
-            for green, obj in greenval_and_obj.items():
-                fg_point = os.path.join(self.efo_directory, obj)
-                if len(os.listdir(fg_point)) != 0:
-                    fg = random.choice(os.listdir(fg_point))
-                    fg_path = os.path.join(fg_point, fg)
-                    msk_fldr = os.path.join(os.path.dirname(self.efo_directory),
-                            OUTPUT_FOLDERS[4])
-                    msk_path = os.path.join(msk_fldr, obj, fg)
-                    mask = Image.open(msk_path).convert('L')
-                    foreground = Image.open(fg_path)
-                    ColourRGB = (RED, green, BLUE)
-
-                    foreground, mask = scaled(foreground,
-                                            background, mask)
-                    foreground, mask = rotated(foreground, mask)
-                    foreground, mask = flipped(foreground, mask)
-                    background, bin_mask = placed(foreground,
-                                                background,
-                                                mask,
-                                                bin_mask,
-                                                ColourRGB)
-            background.save(img_name)
-            bin_mask.save(cm_name)
-
-            # Saving the annotation masks
-            save_annotation_masks(bin_mask,
-                                img_number,
-                                greenval_and_obj,
-                                output_dir)
+        background = self.get_cache().get(('bg', bg_path, self.resolution),
+                                        loader)
+        return background.copy()
+
+    def level_path(self, fg_path: str, target_width: int):
+        """
+        Path of the pyramid level of the foreground to
+        resize to target_width from, None for the full
+        resolution. The levels of a foreground are listed once
+        """
+        if target_width is None:
+            return None
+        if fg_path not in self._levels:
+            folder = pyramid.level_folder(self.pyramid_directory,
+                                        fg_path)
+            self._levels[fg_path] = (folder,
+                                    pyramid.level_widths(folder))
+        folder, widths = self._levels[fg_path]
+        return pyramid.nearest_level(folder, widths, target_width)
+
+    def load_foreground(self, fg_path: str, msk_path: str,
+                        target_width: int = None):
+        """
+        Returns the decoded foreground and mask, these
+        are only read by the transforms so they are not copied.
+        With target_width they are read from the nearest
+        larger pyramid level
+        """
+        level = self.level_path(fg_path, target_width)
+        if level is not None:
+            def level_loader():
+                foreground = Image.open(level)
+                foreground.load()
+                return foreground
+            foreground = self.get_cache().get(('level', level),
+                                            level_loader)
+            return foreground, foreground.getchannel('A')
+
+        def fg_loader():
+            foreground = Image.open(fg_path)
+            foreground.load()
+            return foreground
+        def msk_loader():
+            return Image.open(msk_path).convert('L')
+        cache = self.get_cache()
+        foreground = cache.get(('fg', fg_path), fg_loader)
+        mask = cache.get(('mask', msk_path), msk_loader)
+        return foreground, mask
+
+    def load_rgba(self, fg_path: str, msk_path: str,
+                target_width: int = None):
+        """
+        Returns the foreground as a hxwx4 uint8 array
+        with the mask as fourth channel, for the numpy backend.
+        With target_width it is read from the nearest larger
+        pyramid level
+        """
+        level = self.level_path(fg_path, target_width)
+        if level is not None:
+            def level_loader():
+                return cv2.cvtColor(cv2.imread(level, cv2.IMREAD_UNCHANGED),
+                                    cv2.COLOR_BGRA2RGBA)
+            # Its own key, load_foreground caches the level as PIL
+            return self.get_cache().get(('level_rgba', level),
+                                        level_loader)
+
+        def loader():
+            foreground = Image.open(fg_path).convert('RGB')
+            mask = Image.open(msk_path).convert('L')
+            return np.dstack((np.asarray(foreground),
+                            np.asarray(mask)))
+        return self.get_cache().get(('rgba', fg_path, msk_path),
+                                    loader)
+
+    def compose_pil(self, bg_path: str,
+                    objects: list,
+                    rng=random):
+        """
+        PIL backend of compose_image. The objects are
+        scaled, rotated, flipped and pasted one by one.
+        Inputs:
+        bg_path = str; path to the background
+        objects = list of classes, object k gets
+                instance id k+1
+        rng = random.Random of the image, see image_rng
+        Output: composed PIL Image and uint16 label map
+        of the instance ids
+        """
+        catalog = self.get_catalog()
+        background = self.load_background(bg_path)
+        bg_wide, bg_high = background.size
+        label_map = np.zeros((bg_high, bg_wide), dtype=np.uint16)
+
+        for instance_id, obj in enumerate(objects, start=1):
+            asset = catalog.sample_foreground(obj, rng)
+            if asset is not None:
+                fg_path, msk_path = asset
+                new_width = random_width(background, rng)
+                foreground, mask = self.load_foreground(fg_path,
+                                                    msk_path,
+                                                    new_width)
+
+                foreground, mask = scaled(foreground,
+                                        background, mask,
+                                        new_width=new_width)
+                foreground, mask = rotated(foreground, mask,
+                                        rng=rng)
+                foreground, mask = flipped(foreground, mask,
+                                        rng=rng)
+                placed_at = random_placement(background, rng)
+                background, _ = placed(foreground,
+                                    background,
+                                    mask,
+                                    placed_at=placed_at)
+                compositing.paste_label(label_map, mask,
+                                    placed_at, instance_id)
+        return background, label_map
+
+    def compose_numpy(self, bg_path: str,
+                    objects: list,
+                    rng=random):
+        """
+        Numpy backend of compose_image. The objects are
+        warped and blended into the background array and
+        their instance ids written into the label map.
+        Inputs: same as compose_pil
+        Output: composed PIL Image and uint16 label map
+        of the instance ids
+        """
+        catalog = self.get_catalog()
+        canvas = np.array(self.load_background(bg_path).convert('RGB'))
+        label_map = np.zeros(canvas.shape[:2], dtype=np.uint16)
+        bg_high, bg_wide = label_map.shape
+
+        for instance_id, obj in enumerate(objects, start=1):
+            asset = catalog.sample_foreground(obj, rng)
+            if asset is None:
+                continue
+            # Same random ranges as scaled, rotated,
+            # flipped and placed
+            new_width = rng.randrange(math.floor(0.005*bg_wide),
+                            math.ceil(0.6*bg_wide))
+            rgba = self.load_rgba(*asset, target_width=new_width)
+            fg_high, fg_wide = rgba.shape[:2]
+            new_height = int(fg_high * (new_width/fg_wide))
+            angle = rng.randrange(0, 359)
+            flip = rng.choice((True, False))
+            x = rng.randrange(int(-0.1*bg_wide), int(0.8*bg_wide))
+            y = rng.randrange(int(-0.1*bg_high), int(0.8*bg_high))
+            if new_width < 1 or new_height < 1:
+                continue
+            compositing.composite(canvas, label_map, rgba,
+                                (new_width, new_height),
+                                angle, flip, (x, y),
+                                instance_id)
+
+        return Image.fromarray(canvas), label_map
+
+    def get_catalog(self):
+        """
+        Returns the asset catalog, indexing the
+        asset folders on the first call
+        """
+        if self.catalog is None:
+            self.catalog = AssetCatalog.load_or_build(self.catalog_path,
+                                self.datafolder,
+                                self.efo_directory,
+                                classes=self.classes_to_include)
+        return self.catalog
+
+    def compose(self, workers=1, seed=None, append=False):
+        """
+        Composes num_of_images images.
+        Inputs:
+        workers = int; number of worker processes, with 1
+                the images are composed in this process
+        seed = int; base seed of the random streams. Every
+                image has its own stream, see image_rng, so the
+                output does not depend on the number of workers
+                and any image can be composed again on its own
+                with compose_image. Random if None
+        append = bool; in the inline annotation mode, add the
+                images to the existing instances json instead of
+                starting a new one. The image ids are the image
+                numbers, so the numbers have to follow the ids
+                already in the json
+        """
+        # Output numbers are reserved up front so that
+        # workers never race on file names
+        allocator = fldr_chk.IndexAllocator(self.output_directory,
+                                OUTPUT_EXTENSION)
+        start = allocator.reserve(self.num_of_images)
+        img_numbers = list(range(start,
+                            start + self.num_of_images))
+        if seed is None:
+            seed = random.randrange(2**32)
+        self.seed = seed
+        print(f"Composing with seed {seed}")
+        # Index the assets once, the workers get a copy
+        self.get_catalog()
+
+        writer = None
+        if self.annotation_mode == 'inline':
+            writer = annot.open_writer(self.dataset_name, append=append,
+                            output_dir=os.path.dirname(self.output_directory))
+            # Numbering starts again at 1 once the output folder
+            # is emptied, the ids of the json would repeat
+            if start <= writer.max_image_id:
+                writer.close()
+                raise ValueError(f"Image number {start} is not after the "
+                                f"last image id {writer.max_image_id} of "
+                                f"{writer.json_path}, compose without append "
+                                f"to start a new json")
+
+        if workers <= 1:
+            for img_number in tqdm(img_numbers):
+                record = self.compose_image(str(img_number))
+                write_inline_annotations(writer, [record])
+            self.finish_outputs()
+            print_cache_stats([self.get_cache().stats()])
+            if writer is not None:
+                writer.close()
+            return
+
+        # Small contiguous chunks of numbers are handed out to
+        # the workers as they become free. In the shards mode a
+        # chunk is one shard, so the shards do not depend on
+        # which worker composed them
+        chunk_size = self.shard_size if self.output_format == 'shards' \
+                    else COMPOSE_CHUNK
+        chunks = [img_numbers[i:i+chunk_size]
+                for i in range(0, len(img_numbers), chunk_size)]
+        cache_stats = []
+        # imap keeps the chunks in order of the image numbers
+        with multiprocessing.Pool(min(workers, len(chunks)),
+                                initializer=_init_compose_worker,
+                                initargs=(self,)) as pool, \
+                tqdm(total=len(img_numbers)) as progress:
+            for records, stats in pool.imap(_compose_worker, chunks):
+                write_inline_annotations(writer, records)
+                cache_stats.append(stats)
+                progress.update(len(records))
+        print_cache_stats(cache_stats)
+        if writer is not None:
+            writer.close()
+
+    def compose_image(self, img_number: str,
+                    seed: int = None):
+        """
+        Composes a single image and saves it with
+        its coloured mask and annotation masks, or
+        writes it to the current shard
+        Inputs:
+        img_number = str; number used as file name
+        seed = int; base seed, the seed of the last
+                compose if None. The same seed and image
+                number give the same image
+        Output: None, or the COCO image info and
+        annotations in the inline annotation mode
+        """
+        if seed is None:
+            seed = self.seed
+        rng = image_rng(seed, img_number)
+        final_path = os.path.join(self.output_directory,
+                            img_number)
+        img_name = f"{final_path}.jpg"
+        
+        # Coloured annotation mask
+        output_dir = os.path.dirname(self.output_directory)
+        cm_path = os.path.join(output_dir,
+                                OUTPUT_FOLDERS[2],
+                                img_number)
+        cm_name = f"{cm_path}.png"
+
+        # Number of objects to add in the image
+        NumObjects = rng.randrange(1,
+                    self.max_objects_in_images+1)
+
+        # Classes of the objects, object k is
+        # instance k+1 in the label map
+        objects = [rng.choice(self.classes_to_include)
+                for _ in range(NumObjects)]
+        
+        # Background image
+        bg_path = self.get_catalog().sample_background(rng)
+
+        # TODO: Adding negative examples
+
+        if self.backend == 'numpy':
+            background, label_map = self.compose_numpy(bg_path,
+                                                objects, rng)
+        else:
+            background, label_map = self.compose_pil(bg_path,
+                                                objects, rng)
+        # Masks of the visible instances, in one pass
+        regions = compositing.instance_regions(label_map,
+                                            NumObjects)
+
+        # Encoding and saving overlap with the next image
+        io_writer = self.get_io_writer()
+
+        if self.output_format == 'shards':
+            instances = []
+            for instance_id, offset, local_mask in regions:
+                bbox, area = compositing.region_box(offset, local_mask)
+                instances.append({'id': instance_id,
+                                'category': objects[instance_id - 1],
+                                'bbox': bbox,
+                                'area': area})
+            metadata = {'objects': objects,
+                        'instances': instances,
+                        'seed': seed}
+            # Written in order from this thread, so the shard
+            # contents and names do not depend on the writer threads
+            self.get_shard_writer().write(img_number, background,
+                                        label_map, metadata)
+        else:
+            io_writer.submit(save_composition,
+                            img_name, background,
+                            cm_name, label_map,
+                            NumObjects)
+
+        if self.annotation_mode == 'inline':
+            return annot.inline_annotations(img_name,
+                                background.size,
+                                [(objects[instance_id - 1].lower(),
+                                    local_mask, offset)
+                                for instance_id, offset, local_mask
+                                in regions],
+                                int(img_number))
+
+        if self.output_format == 'shards':
+            return
+
+        # Saving the annotation masks
+        io_writer.submit(save_annotation_masks,
+                        label_map,
+                        img_number,
+                        objects,
+                        output_dir,
+                        regions)
+
+def image_rng(seed, img_number):
+    """
+    Random generator of a single image. Its stream only
+    depends on the base seed and the image number, not on
+    the images composed before it or on the worker
+    Inputs:
+    seed = base seed, a random stream if None
+    img_number = number of the image
+    Output: random.Random
+    """
+    if seed is None:
+        return random.Random()
+    # str seeds are hashed with sha512, the same in every process
+    return random.Random(f"{seed}-{img_number}")
+
+# Composer of a parallel compose worker process
+_worker_composer = None
+
+def _init_compose_worker(composer):
+    """
+    Initializer of the parallel compose workers, the
+    composer is pickled once per worker, not per chunk
+    """
+    global _worker_composer
+    _worker_composer = composer
+
+def _compose_worker(img_numbers):
+    """
+    Worker for the parallel compose, composes a chunk
+    of image numbers and saves its outputs
+    Output: the records of the chunk and the cache
+    hits and misses while composing it
+    """
+    composer = _worker_composer
+    cache = composer.get_cache()
+    hits, misses = cache.hits, cache.misses
+    records = [composer.compose_image(str(img_number))
+            for img_number in img_numbers]
+    composer.finish_outputs()
+    return records, {'hits': cache.hits - hits,
+                    'misses': cache.misses - misses}
+
+def write_inline_annotations(writer, records: list):
+    """
+    Writes the COCO records returned by compose_image.
+    The image ids are the image numbers, the annotation
+    ids continue from the last one in the writer
+    Inputs:
+    writer = annotator CocoWriter, nothing is written if None
+    records = list of (image info, annotations) tuples
+    """
+    if writer is None:
+        return
+    for image_info, annotations in records:
+        writer.add_image(image_info)
+        for annotation_info in annotations:
+            annotation_info['id'] = writer.next_annotation_id
+            writer.add_annotation(annotation_info)
+
+def print_cache_stats(cache_stats: list):
+    """
+    Prints the summed hit and miss counters of
+    the asset caches of all workers
+    """
+    hits = sum(stats['hits'] for stats in cache_stats)
+    misses = sum(stats['misses'] for stats in cache_stats)
+    total = max(hits + misses, 1)
+    print(f"Asset cache: {hits} hits, {misses} misses "
+          f"({100*hits/total:.1f}% hit rate)")
+
+def random_width(background, rng=random):
+    """
+    Random width of a foreground with respect
+    to the width of the background
+    """
+    bg_width, _ = background.size
+    return rng.randrange((math.floor(0.005*bg_width)),
+                    math.ceil(0.6*bg_width))
 
 def scaled(foreground, background, mask,
-            scaled_to=None):
+            scaled_to=None,
+            rng=random,
+            new_width=None):
     """
     Function for scaling the foreground object
     with respect to the background
@@ -123,12 +628,13 @@ def scaled(foreground, background, mask,
     scaled_to = float; scaling factor of foreground,
             if None then uses random values
             with respect to the background
+    rng = random generator of the random values
+    new_width = int; width to scale to, random if None
     """
     if scaled_to is None:
-        bg_width, _ = background.size
         fg_width, fg_height = foreground.size
-        new_width = random.randrange((math.floor(0.005*bg_width)),
-                        math.ceil(0.6*bg_width))
+        if new_width is None:
+            new_width = random_width(background, rng)
         new_height = int(fg_height * (new_width/fg_width))
         new_size = (new_width, new_height)
         resized_fg = foreground.resize(new_size,
@@ -138,17 +644,22 @@ def scaled(foreground, background, mask,
     return resized_fg, resized_mask
 
 def rotated(foreground, mask,
-            angle=random.randrange(0,359)):
+            angle=None,
+            rng=random):
     """
     Function for rotating the foreground object
     Also performs the same operation for the mask
     Inputs:
     foreground = PIL Image of foreground
     mask = PIL Image of mask
-    angle = angle in degrees to rotate the foreground
+    angle = angle in degrees to rotate the foreground,
+            random if None
+    rng = random generator of the random angle
     Outputs:
     foreground and mask with rotation performed
     """
+    if angle is None:
+        angle = rng.randrange(0,359)
     foreground = foreground.rotate(angle,
                     resample=Image.BICUBIC)
     mask = mask.rotate(angle,
@@ -156,7 +667,8 @@ def rotated(foreground, mask,
     return foreground, mask
 
 def flipped(foreground, mask,
-            flip_foreground=random.choice((True, False))):
+            flip_foreground=None,
+            rng=random):
     """
     Performs Mirror operation on the foreground
     object and the mask of the foreground
@@ -164,21 +676,46 @@ def flipped(foreground, mask,
     foreground = PIL Image of foreground
     mask = PIL Image of mask
     flip_foreground = Bool to decide whether
-    or not to mirror the foreground object
+    or not to mirror the foreground object,
+    random if None
+    rng = random generator of the random choice
     Outputs:
     foreground and mask with the operation
     performed
     """
+    if flip_foreground is None:
+        flip_foreground = rng.choice((True, False))
     if flip_foreground:
         foreground = ImageOps.mirror(foreground)
         mask = ImageOps.mirror(mask)
     
     return foreground, mask
 
+def random_placement(background, rng=random):
+    """
+    Random location for the top left corner of
+    a foreground on the background
+    rng = random generator of the location
+    Output: Tuple containing x and y co-ordinates
+    """
+    bg_wide, bg_high = background.size
+    # Location on X axis
+    x_low_limit = -0.1*bg_wide
+    x_up_limit = 0.8*bg_wide
+    x = rng.randrange(x_low_limit,
+                        x_up_limit)
+    # Location on Y axis
+    y_low_limit = -0.1*bg_high
+    y_up_limit = 0.8*bg_high
+    y = rng.randrange(y_low_limit,
+                        y_up_limit)
+    return (x,y)
+
 def placed(foreground, background, mask,
             bin_mask=None,
             mask_colour=None,
-            placed_at=None):
+            placed_at=None,
+            rng=random):
     """
     Function for placing the foreground object
     on the background.
@@ -191,24 +728,15 @@ def placed(foreground, background, mask,
     bin_mask = PIL Image of the final 
                 annotation mask
     mask_colour = Tuple of RGB values for mask
+    rng = random generator of the location when
+            placed_at is None
 
     Outputs:
     returns composed image and the final
     coloured annotation mask
     """
     if placed_at == None:
-        bg_wide, bg_high = background.size
-        # Location on X axis
-        x_low_limit = -0.1*bg_wide
-        x_up_limit = 0.8*bg_wide
-        x = random.randrange(x_low_limit,
-                            x_up_limit)
-        # Location on Y axis
-        y_low_limit = -0.1*bg_high
-        y_up_limit = 0.8*bg_high
-        y = random.randrange(y_low_limit,
-                            y_up_limit)
-        placed_at = (x,y)
+        placed_at = random_placement(background, rng)
     
     # Compositing the foreground on the background
     background.paste(foreground,
@@ -236,35 +764,71 @@ def mask_maker(mask, mask_colour):
     mask_coloured.putalpha(mask)
     return mask_coloured
 
-def save_annotation_masks(bin_mask,
+def save_composition(img_name:str, background,
+                    cm_name:str, label_map,
+                    num_objects:int):
+    """
+    Saves the composed image and its coloured mask
+    """
+    background.save(img_name)
+    coloured_mask(label_map,
+                instance_greens(num_objects)).save(cm_name)
+
+def save_annotation_masks(label_map,
                         img_number:str,
-                        dict_color_object:dict,
-                        output_dir:str):
+                        objects:list,
+                        output_dir:str,
+                        regions:list=None):
     """
     Function for saving the annotation masks
     of the different objects in the format 
     required for PyCocoCreatorTools
+    label_map= uint16 array of the instance ids
     img_number= str; image number to save the
                 binary mask
-    dict_color_object= dict; dictionary of 
-                        green value and 
-                        object name
+    objects= list of the object names, object k
+            is instance k+1 in the label map
     output_dir = str; Path to directory where
                 annotation masks will be saved
+    regions = instance masks from
+            compositing.instance_regions, found
+            from the label map if None
     """
-    instance_num = 0
-    for green, object in dict_color_object.items():
-        object = object.lower()
+    if regions is None:
+        regions = compositing.instance_regions(label_map,
+                                            len(objects))
+    for instance_id, (x0, y0), local_mask in regions:
+        object = objects[instance_id - 1].lower()
+        instance_num = instance_id - 1
         annotationmask_name = f"{img_number}_{object}_{instance_num}.png"
-        ColourBGR = (BLUE, green, RED)
-        anno_mask = annotation_mask_maker(bin_mask,
-                                        ColourBGR)
+        anno_mask = np.zeros(label_map.shape, dtype=np.uint8)
+        mask_h, mask_w = local_mask.shape
+        anno_mask[y0:y0+mask_h, x0:x0+mask_w] = local_mask*255
         anno_mask_path = os.path.join(output_dir,
                         OUTPUT_FOLDERS[0],
                         annotationmask_name)
-        instance_num +=1
         cv2.imwrite(anno_mask_path, anno_mask)
 
+def instance_greens(num_instances:int):
+    """
+    Green values of the instances in the coloured
+    mask, spread over 1 to 254. They repeat when
+    there are more than 254 instances
+    """
+    step = max(int(255/num_instances), 1)
+    return [1 + (k*step) % 254 for k in range(num_instances)]
+
+def coloured_mask(label_map, greens: list):
+    """
+    Coloured annotation mask from a label map, instance
+    k gets the colour (RED, greens[k-1], BLUE)
+    """
+    lut = np.zeros((len(greens) + 1, 4), dtype=np.uint8)
+    lut[:, 3] = 255
+    for instance_id, green in enumerate(greens, start=1):
+        lut[instance_id] = (RED, green, BLUE, 255)
+    return Image.fromarray(lut[label_map], 'RGBA')
+
 def annotation_mask_maker(bin_mask, ColourBGR):
     """
     Makes a black and white annotation masks for each object instance 
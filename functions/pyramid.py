@@ -0,0 +1,145 @@
+"""
+Pre-scaled copies of the extracted foregrounds. Every
+foreground and its mask are halved repeatedly and saved as
+RGBA levels, so the image composer resizes objects from the
+nearest larger level instead of the full resolution cutout.
+Layout: <pyramid folder>/<class>/<foreground name>/<width>.png
+"""
+import os
+import cv2
+import numpy as np
+from functions.folder_check import OUTPUT_FOLDERS
+
+# Smallest level that is saved
+MIN_WIDTH = 32
+LEVEL_EXTENSION = '.png'
+
+
+def level_folder(pyramid_directory: str, fg_path: str):
+    """
+    Folder of the levels of a foreground, named after
+    the class folder and the file name of the foreground
+    """
+    obj = os.path.basename(os.path.dirname(fg_path))
+    name = os.path.splitext(os.path.basename(fg_path))[0]
+    return os.path.join(pyramid_directory, obj, name)
+
+
+def build_pyramid(fg_path: str,
+                msk_path: str,
+                pyramid_directory: str,
+                min_width: int = MIN_WIDTH):
+    """
+    Saves the levels of a foreground. Level k is the
+    foreground halved k times, the full resolution itself
+    is not saved. Levels newer than the foreground are kept,
+    older ones are replaced.
+    Inputs:
+    fg_path = str; path to the extracted foreground
+    msk_path = str; path to its mask
+    pyramid_directory = str; path to the Pyramid folder
+    min_width = int; no level is narrower than this
+    Output: list of the widths of the levels
+    """
+    folder = level_folder(pyramid_directory, fg_path)
+    if os.path.isdir(folder) and \
+            os.path.getmtime(folder) >= os.path.getmtime(fg_path):
+        return level_widths(folder)
+    # Levels of an older foreground are removed, a smaller
+    # foreground would otherwise keep its wider levels
+    for width in level_widths(folder):
+        os.remove(os.path.join(folder, f'{width}{LEVEL_EXTENSION}'))
+
+    foreground = cv2.imread(fg_path, cv2.IMREAD_COLOR)
+    mask = cv2.imread(msk_path, cv2.IMREAD_GRAYSCALE)
+    if foreground is None or mask is None:
+        return []
+    height, width = foreground.shape[:2]
+    if mask.shape != (height, width):
+        mask = cv2.resize(mask, (width, height))
+    level = np.dstack((foreground, mask))
+
+    os.makedirs(folder, exist_ok=True)
+    widths = []
+    level_width = width // 2
+    while level_width >= min_width:
+        # The height follows the full resolution aspect
+        level_height = max(round(height * level_width/width), 1)
+        level = cv2.resize(level, (level_width, level_height),
+                        interpolation=cv2.INTER_AREA)
+        cv2.imwrite(os.path.join(folder,
+                        f'{level_width}{LEVEL_EXTENSION}'), level)
+        widths.append(level_width)
+        level_width //= 2
+    return widths
+
+
+def build_pyramids(efo_directory: str,
+                mask_directory: str = None,
+                pyramid_directory: str = None,
+                classes: list = None,
+                min_width: int = MIN_WIDTH):
+    """
+    Builds the pyramids of all extracted foregrounds
+    Inputs:
+    efo_directory = str; path to the EFObjects folder
+    mask_directory = str; path to the Mask folder, if
+            None the Mask folder next to efo_directory
+    pyramid_directory = str; path to the Pyramid folder, if
+            None the Pyramid folder next to efo_directory
+    classes = list of classes, all subfolders of
+            efo_directory if None
+    min_width = int; no level is narrower than this
+    Output: number of foregrounds with a pyramid
+    """
+    output_dir = os.path.dirname(efo_directory)
+    if mask_directory is None:
+        mask_directory = os.path.join(output_dir, OUTPUT_FOLDERS[4])
+    if pyramid_directory is None:
+        pyramid_directory = os.path.join(output_dir, OUTPUT_FOLDERS[5])
+    if classes is None:
+        classes = sorted(os.listdir(efo_directory))
+
+    built = 0
+    for obj in classes:
+        fg_point = os.path.join(efo_directory, obj)
+        msk_point = os.path.join(mask_directory, obj)
+        if not os.path.isdir(fg_point) or not os.path.isdir(msk_point):
+            continue
+        for fg in sorted(os.listdir(fg_point)):
+            msk_path = os.path.join(msk_point, fg)
+            if fg.endswith('.png') and os.path.isfile(msk_path):
+                if build_pyramid(os.path.join(fg_point, fg), msk_path,
+                                pyramid_directory, min_width):
+                    built += 1
+    return built
+
+
+def level_widths(folder: str):
+    """
+    Widths of the saved levels in a level folder,
+    smallest first. Empty if there is no pyramid
+    """
+    if not os.path.isdir(folder):
+        return []
+    return sorted(int(level[:-len(LEVEL_EXTENSION)])
+                for level in os.listdir(folder)
+                if level.endswith(LEVEL_EXTENSION)
+                and level[:-len(LEVEL_EXTENSION)].isdigit())
+
+
+def nearest_level(folder: str,
+                widths: list,
+                target_width: int):
+    """
+    Path of the smallest level at least target_width
+    wide, None if the full resolution is needed
+    Inputs:
+    folder = str; level folder of the foreground
+    widths = list of the level widths, see level_widths
+    target_width = int; width the object is scaled to
+    """
+    for width in widths:
+        if width >= target_width:
+            return os.path.join(folder, f'{width}{LEVEL_EXTENSION}')
+    return None
@@ -0,0 +1,146 @@
+"""
+CascadePSP refinement as a separate pipeline stage. The
+coarse U2Net masks are queued with their images and refined
+on a thread of their own, so refinement runs while U2Net
+works on the next batches.
+"""
+import math
+import queue
+import threading
+import time
+import cv2
+
+# Working resolution budget of the refinement in pixels,
+# larger images are refined downscaled
+MAX_PIXELS = 1920 * 1080
+# Refined masks are binarized at this value
+MASK_THRESHOLD = 210
+
+_DONE = object()
+
+
+def refine_mask(refiner, image, mask,
+                max_pixels: int = None,
+                L: int = 900,
+                fast: bool = True):
+    """
+    Refines a coarse mask with CascadePSP and binarizes it
+    Inputs:
+    refiner = segmentation_refinement Refiner
+    image = HxWx3 image of the mask
+    mask = HxW uint8 coarse mask
+    max_pixels = int; images with more pixels are refined
+            at this many pixels and the mask scaled back,
+            no limit if None
+    L, fast = settings of Refiner.refine
+    Output: HxW uint8 mask of 0 and 255
+    """
+    height, width = mask.shape[:2]
+    scale = 1.0
+    if max_pixels is not None and height*width > max_pixels:
+        scale = math.sqrt(max_pixels/(height*width))
+    if scale < 1.0:
+        size = (max(int(width*scale), 1), max(int(height*scale), 1))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        mask = cv2.resize(mask, size, interpolation=cv2.INTER_LINEAR)
+
+    output_mask = refiner.refine(image, mask,
+                            fast=fast,
+                            L=min(L, max(mask.shape[:2])))
+    if scale < 1.0:
+        output_mask = cv2.resize(output_mask, (width, height),
+                            interpolation=cv2.INTER_LINEAR)
+
+    # Binarizing the image to avoid gray areas
+    _, output_mask = cv2.threshold(output_mask,
+                            MASK_THRESHOLD, 255,
+                            cv2.THRESH_BINARY)
+    return output_mask
+
+
+class RefineStage:
+    def __init__(self, refiner, save_fn,
+                max_pixels: int = MAX_PIXELS,
+                queue_size: int = 16,
+                group_size: int = 8):
+        """
+        Initializing the stage, its thread starts right away
+        refiner = segmentation_refinement Refiner
+        save_fn = function called as save_fn(image, mask, *args)
+                with every refined mask
+        max_pixels = int; working resolution budget, see refine_mask
+        queue_size = int; masks that may wait for refinement,
+                submit blocks when it is reached
+        group_size = int; queued masks are taken in groups of up
+                to this many and refined ordered by size, so that
+                consecutive calls work on the same shapes
+        """
+        self.refiner = refiner
+        self.save_fn = save_fn
+        self.max_pixels = max_pixels
+        self.group_size = group_size
+        self.refine_seconds = 0.0
+        self.save_seconds = 0.0
+        self.processed = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._run,
+                                        name='sig-refine',
+                                        daemon=True)
+        self._thread.start()
+
+    def submit(self, image, mask, *args):
+        """
+        Queues a coarse mask, args are passed on to save_fn
+        """
+        if self._error is not None:
+            raise self._error
+        self._queue.put((image, mask, args))
+
+    def _next_group(self):
+        """
+        Waits for a mask and takes the ones queued after
+        it, up to group_size. Ends the group at _DONE
+        """
+        group = [self._queue.get()]
+        while group[-1] is not _DONE and len(group) < self.group_size:
+            try:
+                group.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return group
+
+    def _run(self):
+        done = False
+        while not done:
+            group = self._next_group()
+            if group[-1] is _DONE:
+                done = True
+                group.pop()
+            if self._error is not None:
+                # Drained so that submit does not block
+                continue
+            group.sort(key=lambda item: item[0].shape[:2])
+            try:
+                for image, mask, args in group:
+                    start = time.perf_counter()
+                    mask = refine_mask(self.refiner, image, mask,
+                                    self.max_pixels)
+                    saved = time.perf_counter()
+                    self.save_fn(image, mask, *args)
+                    self.refine_seconds += saved - start
+                    self.save_seconds += time.perf_counter() - saved
+                    self.processed += 1
+            except BaseException as error:
+                self._error = error
+
+    def close(self):
+        """
+        Waits until all queued masks are refined and
+        saved, raises the error of the stage if any
+        """
+        if self._thread.is_alive():
+            self._queue.put(_DONE)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
@@ -0,0 +1,156 @@
+"""
+Sharded output for composed data. Instead of a .jpg, a
+coloured mask and one .png per instance for every image,
+the images, instance id label maps and metadata are
+written into fixed-size tar shards. Every shard has a json
+index with the byte offsets of its members, so the shards
+can be streamed back or read at random.
+"""
+import io
+import json
+import os
+import tarfile
+import cv2
+import numpy as np
+from PIL import Image
+
+# Members of a sample in a shard
+IMAGE_SUFFIX = '.jpg'
+LABEL_SUFFIX = '.labels.png'
+META_SUFFIX = '.json'
+INDEX_SUFFIX = '.idx.json'
+
+
+class ShardWriter:
+    def __init__(self, shard_dir: str,
+                shard_size: int = 1000,
+                prefix: str = 'shard'):
+        """
+        Initializing the writer
+        shard_dir = str; folder of the shards
+        shard_size = int; number of samples per shard
+        prefix = str; shard files are named
+                <prefix>-<first key>.tar
+        """
+        self.shard_dir = shard_dir
+        self.shard_size = shard_size
+        self.prefix = prefix
+        self._tar = None
+        self._shard_path = None
+        self._index = {}
+        os.makedirs(shard_dir, exist_ok=True)
+
+    def _open_shard(self, key: str):
+        # Named after the first key, so writers with
+        # different keys never write the same shard
+        name = f'{self.prefix}-{int(key):09d}' if key.isdigit() \
+                else f'{self.prefix}-{key}'
+        self._shard_path = os.path.join(self.shard_dir, f'{name}.tar')
+        self._tar = tarfile.open(self._shard_path, 'w')
+        self._index = {}
+
+    def _add_member(self, name: str, data: bytes):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self._tar.addfile(info, io.BytesIO(data))
+        # The data ends the member, padded to whole blocks
+        padded = -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        return [self._tar.offset - padded, len(data)]
+
+    def write(self, key: str, image,
+            label_map, metadata: dict):
+        """
+        Adds a sample to the current shard. Samples
+        are written in the order of the calls, call it
+        from one thread in key order
+        Inputs:
+        key = str; name of the sample, the image number
+        image = PIL Image of the composition
+        label_map = uint16 array of the instance ids
+        metadata = dict saved as json with the sample
+        """
+        jpeg = io.BytesIO()
+        image.save(jpeg, format='JPEG')
+        _, label_png = cv2.imencode('.png', label_map)
+        meta = json.dumps(metadata).encode()
+
+        if self._tar is None:
+            self._open_shard(key)
+        self._index[key] = {
+            'image': self._add_member(key + IMAGE_SUFFIX, jpeg.getvalue()),
+            'labels': self._add_member(key + LABEL_SUFFIX, label_png.tobytes()),
+            'metadata': self._add_member(key + META_SUFFIX, meta),
+        }
+        if len(self._index) >= self.shard_size:
+            self._close_shard()
+
+    def close(self):
+        """
+        Closes the current shard and writes its index
+        """
+        self._close_shard()
+
+    def _close_shard(self):
+        if self._tar is None:
+            return
+        self._tar.close()
+        index_path = self._shard_path[:-len('.tar')] + INDEX_SUFFIX
+        with open(index_path, 'w') as index_json:
+            json.dump(self._index, index_json)
+        self._tar = None
+
+
+class ShardReader:
+    def __init__(self, shard_dir: str):
+        """
+        Reads the shards written by ShardWriter
+        shard_dir = str; folder of the shards
+        """
+        self.shard_dir = shard_dir
+        self.shards = sorted(f[:-len(INDEX_SUFFIX)]
+                            for f in os.listdir(shard_dir)
+                            if f.endswith(INDEX_SUFFIX))
+
+    def _read_index(self, shard: str):
+        with open(os.path.join(self.shard_dir, shard + INDEX_SUFFIX)) as index_json:
+            return json.load(index_json)
+
+    def __len__(self):
+        return sum(len(self._read_index(shard)) for shard in self.shards)
+
+    def __iter__(self):
+        """
+        Streams the samples shard by shard as dicts with
+        the key, image, label_map and metadata
+        """
+        for shard in self.shards:
+            index = self._read_index(shard)
+            with open(os.path.join(self.shard_dir, shard + '.tar'), 'rb') as tar:
+                for key, members in index.items():
+                    yield decode_sample(key, tar, members)
+
+
+def _read_member(tar, member):
+    offset, size = member
+    tar.seek(offset)
+    return tar.read(size)
+
+
+def decode_sample(key: str, tar, members: dict):
+    """
+    Decodes a sample from an open shard file
+    Inputs:
+    key = str; name of the sample
+    tar = shard opened in binary mode
+    members = index entry of the sample
+    """
+    image = Image.open(io.BytesIO(_read_member(tar, members['image'])))
+    image.load()
+    label_png = np.frombuffer(_read_member(tar, members['labels']),
+                            dtype=np.uint8)
+    label_map = cv2.imdecode(label_png, cv2.IMREAD_UNCHANGED)
+    metadata = json.loads(_read_member(tar, members['metadata']))
+    return {'key': key,
+            'image': image,
+            'label_map': label_map,
+            'metadata': metadata}
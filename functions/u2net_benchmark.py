@@ -0,0 +1,85 @@
+"""
+Benchmark of the U2Net model types. Every model runs on
+the same images, the fused d0 masks are compared with the
+masks of the full U2NET and the throughput of the network
+is measured.
+Usage: python -m functions.u2net_benchmark <image folder>
+"""
+import argparse
+import glob
+import os
+import time
+import numpy as np
+import functions.u2net_infer as u2
+
+
+def mask_iou(mask, reference):
+    """
+    IoU of two masks thresholded at 0.5
+    """
+    mask = mask > 0.5
+    reference = reference > 0.5
+    union = np.logical_or(mask, reference).sum()
+    if union == 0:
+        return 1.0
+    return np.logical_and(mask, reference).sum()/union
+
+
+def benchmark(source_folder : str,
+            model_types : tuple = u2.MODEL_TYPES,
+            batch_size : int = 8,
+            max_images : int = None):
+    """
+    Runs every model type on the images of source_folder
+    Inputs:
+    source_folder = str; folder of the images
+    model_types = tuple of u2net_infer.MODEL_TYPES, the
+            fused d0 masks of the first one are the
+            reference of the IoU
+    batch_size = int; images per forward pass
+    max_images = int; only the first images are used if given
+    Output: dict of model type and dict with images_per_sec
+    and the mean IoU with the reference
+    """
+    img_name_list = sorted(glob.glob(os.path.join(source_folder, '*')))
+    img_name_list = [img_name for img_name in img_name_list
+                    if img_name.lower().endswith(('.jpg', '.jpeg',
+                                                '.png', '.bmp'))]
+    img_name_list = img_name_list[:max_images]
+    # Decoded once, only the networks are timed
+    _, loader, _ = u2.image_loader(img_name_list,
+                                batch_size=batch_size,
+                                num_workers=0)
+    batches = [data['image'] for data in loader]
+
+    results = {}
+    reference = None
+    for model_type in model_types:
+        engine = u2.U2Engine(u2.ModelSession(model_type=model_type).u2net,
+                            batch_size=batch_size)
+        # Warm up, the first pass is slower
+        engine.predict(batches[0])
+        start = time.perf_counter()
+        masks = np.concatenate([engine.predict(batch) for batch in batches])
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference = masks
+        results[model_type] = {
+            'images_per_sec': len(masks)/elapsed,
+            'iou': float(np.mean([mask_iou(mask, ref)
+                                for mask, ref in zip(masks, reference)]))}
+        print(f"{model_type:12s} {results[model_type]['images_per_sec']:8.2f} "
+              f"images/sec, IoU with {model_types[0]} "
+              f"{results[model_type]['iou']:.4f}")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('source_folder')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--max-images', type=int, default=None)
+    args = parser.parse_args()
+    benchmark(args.source_folder,
+            batch_size=args.batch_size,
+            max_images=args.max_images)
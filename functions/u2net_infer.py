@@ -1,23 +1,47 @@
 import os
+import time
 from segmentation_refinement.main import Refiner
 import torch
-from torch.autograd import Variable
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.utils.data import Dataset, DataLoader
-from torchvision import transforms
 import cv2
 import glob
 import segmentation_refinement as refine
 from tqdm import tqdm
-from functions.data_loader import RescaleT
 from functions.data_loader import ToTensor
-from functions.data_loader import ToTensorLab
-from functions.data_loader import SalObjDataset
+from functions.data_loader import InferenceDataset
+from functions.data_loader import collate_inference
 import functions.folder_check as fldr_chk
-from PIL import Image
+import functions.cutout as cutout
+from functions.refine_stage import RefineStage, refine_mask, MAX_PIXELS
 import numpy as np
+import random
 from model import U2NET
+from model import U2NETP
+from model.quantize import quantize_static, save_quantized, load_quantized
+from model.optimize import optimize_checked
+
+# torch.inference_mode only exists from torch 1.9 onwards
+_INFERENCE_MODE = getattr(torch, 'inference_mode', torch.no_grad)
+
+U2NET_MODEL_DIR = './model/saved_models/u2net.pth'
+U2NETP_MODEL_DIR = './model/saved_models/u2netp.pth'
+# The int8 U2NETP is made from the U2NETP weights on the first use
+U2NETP_INT8_DIR = './model/saved_models/u2netp_int8.pt'
+# 'u2net' full model, 'u2netp' small model, 'u2netp_int8'
+# small model quantized to int8 for cpu only extraction
+MODEL_TYPES = ('u2net', 'u2netp', 'u2netp_int8')
+MODEL_DIRS = {'u2net': U2NET_MODEL_DIR,
+            'u2netp': U2NETP_MODEL_DIR,
+            'u2netp_int8': U2NETP_INT8_DIR}
+# Images the int8 model is calibrated on
+CALIBRATION_PATH = './Data/Classes'
+CALIBRATION_IMAGES = 64
+# Images the optimized U2Net masks are checked on
+CHECK_IMAGES = 16
+# DataLoader workers decoding the images for U2Net
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
 
 def normPRED(d):
     ma = torch.max(d)
@@ -27,13 +51,27 @@ def normPRED(d):
 
     return dn
 
-def u2_loader(model_dir):
+def normPRED_batch(d):
+    """
+    Same as normPRED but normalizes every prediction
+    in a (N, H, W) batch with its own min and max
+    """
+    flat = d.reshape(d.shape[0], -1)
+    ma = flat.max(dim=1)[0].view(-1, 1, 1)
+    mi = flat.min(dim=1)[0].view(-1, 1, 1)
+
+    dn = (d-mi)/(ma-mi)
+
+    return dn
+
+def u2_loader(model_dir, model_type='u2net'):
     """
     Loads the model for inferences.
     It will be called inside the function for foreground extraction
     'model_dir' is path to the directory where model is located
+    'model_type' is 'u2net' or 'u2netp'
     """
-    net = U2NET(3,1)
+    net = U2NETP(3,1) if model_type == 'u2netp' else U2NET(3,1)
     if torch.cuda.is_available():
         net.load_state_dict(torch.load(model_dir, map_location='cuda'))
         net.cuda()
@@ -43,26 +81,329 @@ def u2_loader(model_dir):
     model_state = "loaded"
     return net, model_state
 
-def dataloader(source_folder):
+def calibration_batches(classes_path : str = CALIBRATION_PATH,
+                        num_images : int = CALIBRATION_IMAGES,
+                        batch_size : int = 8,
+                        seed : int = 0):
+    """
+    Batches of a random sample of the class images,
+    for calibrating the int8 model and checking the
+    optimized model
+    """
+    img_name_list = sorted(glob.glob(os.path.join(classes_path, '*', '*')))
+    img_name_list = [img_name for img_name in img_name_list
+                    if img_name.lower().endswith(('.jpg', '.jpeg',
+                                                '.png', '.bmp'))]
+    if not img_name_list:
+        raise FileNotFoundError(f"No images to calibrate on in {classes_path}")
+    img_name_list = random.Random(seed).sample(img_name_list,
+                                    min(num_images, len(img_name_list)))
+    _, loader, _ = image_loader(img_name_list,
+                                batch_size=batch_size,
+                                num_workers=0)
+    return [data['image'] for data in loader]
+
+def u2netp_int8_loader(model_dir : str = U2NETP_INT8_DIR,
+                    float_model_dir : str = U2NETP_MODEL_DIR,
+                    classes_path : str = CALIBRATION_PATH):
+    """
+    Loads the int8 U2NETP from model_dir. If it does not
+    exist yet or is older than the U2NETP weights, the
+    weights are quantized with a calibration on a sample
+    of the class images and saved to model_dir. Without
+    the U2NETP weights model_dir is always loaded
+    """
+    if os.path.isfile(model_dir) and \
+            (not os.path.isfile(float_model_dir) or
+            os.path.getmtime(model_dir) >= os.path.getmtime(float_model_dir)):
+        return load_quantized(model_dir)
+    net, _ = u2_loader(float_model_dir, 'u2netp')
+    quantized = quantize_static(net, calibration_batches(classes_path))
+    save_quantized(quantized, model_dir)
+    return quantized
+
+class ModelSession:
+    def __init__(self, model_dir : str = None,
+                optimize : bool = False,
+                optimize_options : dict = None,
+                model_type : str = 'u2net'):
+        """
+        Holds the networks used for extraction so that they
+        are loaded once per run and shared by every subfolder.
+        The networks are loaded lazily on first access.
+        model_dir: path to the U2Net weights, the path of
+        MODEL_DIRS of the model_type if None
+        optimize: use the optimized inference mode of U2Net,
+        see model.optimize.optimize_u2net. The masks are checked
+        against the unoptimized network once after loading, on a
+        sample of the class images, the unoptimized network is used
+        if they are not within tolerance
+        optimize_options: keyword arguments of optimize_u2net,
+        e.g. {'bf16': True, 'jit': 'trace'}
+        model_type: one of MODEL_TYPES. 'u2netp_int8' runs on
+        the cpu and is not optimized further
+        """
+        if model_type not in MODEL_TYPES:
+            raise ValueError(f"model_type should be one of {MODEL_TYPES}")
+        if model_dir is None:
+            model_dir = MODEL_DIRS[model_type]
+        self.model_type = model_type
+        self.model_dir = model_dir
+        self.optimize = optimize
+        self.optimize_options = optimize_options or {}
+        self._u2net = None
+        self._refiner = None
+
+    @property
+    def u2net(self):
+        if self._u2net is None and self.model_type == 'u2netp_int8':
+            self._u2net = u2netp_int8_loader(self.model_dir)
+        if self._u2net is None:
+            self._u2net, _ = u2_loader(self.model_dir, self.model_type)
+            if self.optimize:
+                try:
+                    inputs = calibration_batches(num_images=CHECK_IMAGES)
+                except FileNotFoundError as error:
+                    print(f"{error}, the optimized U2Net is not used")
+                    return self._u2net
+                self._u2net, report = optimize_checked(self._u2net,
+                                                    inputs,
+                                                    **self.optimize_options)
+                print(f"Optimized U2Net mask check: mean error "
+                      f"{report['mean_error']:.4f}, IoU {report['iou']:.4f}"
+                      + ("" if report['ok'] else
+                         ", not within tolerance, using the reference"))
+        return self._u2net
+
+    @property
+    def refiner(self):
+        if self._refiner is None:
+            if torch.cuda.is_available():
+                self._refiner = refine.Refiner(device='cuda:0')
+            else:
+                self._refiner = refine.Refiner(device='cpu')
+        return self._refiner
+
+def dataloader(source_folder,
+                batch_size=1,
+                num_workers=DEFAULT_WORKERS,
+                pin_memory=None,
+                prefetch_factor=2):
     """
     Takes the path to the subfolder and loads the images in the subfolder to make masks
+    The batches hold the decoded originals as well, see InferenceDataset
+    pin_memory: page-lock the network inputs for faster copies
+    to the GPU, when a GPU is available if None
+    prefetch_factor: batches every worker prepares ahead
     """
     img_name_list = glob.glob(source_folder + os.sep + '*')
-    test_salobj_dataset = SalObjDataset(img_name_list = img_name_list,
-                                        lbl_name_list = [],
-                                        transform=transforms.Compose([RescaleT(320),
-                                                                      ToTensorLab(flag=0)])
-                                        )
+    return image_loader(img_name_list,
+                        batch_size=batch_size,
+                        num_workers=num_workers,
+                        pin_memory=pin_memory,
+                        prefetch_factor=prefetch_factor)
+
+def image_loader(img_name_list,
+                batch_size=1,
+                num_workers=DEFAULT_WORKERS,
+                pin_memory=None,
+                prefetch_factor=2):
+    """
+    Loads the images of img_name_list in that order, the
+    'imidx' of a sample is its position in the list.
+    Other inputs: see dataloader
+    """
+    # cv2 decode, uint8 resize and float32 normalization,
+    # no dummy label is made
+    test_salobj_dataset = InferenceDataset(img_name_list = img_name_list,
+                                        return_original = True)
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+    loader_options = {}
+    if num_workers > 0:
+        loader_options['prefetch_factor'] = prefetch_factor
     test_salobj_dataloader = DataLoader(test_salobj_dataset,
-                                        batch_size=1,
+                                        batch_size=batch_size,
                                         shuffle=False,
-                                        num_workers=1)
+                                        num_workers=num_workers,
+                                        collate_fn=collate_inference,
+                                        pin_memory=pin_memory,
+                                        **loader_options)
     return test_salobj_dataset, test_salobj_dataloader,img_name_list
 
+class U2Engine:
+    def __init__(self, net,
+                batch_size : int = 8,
+                num_workers : int = DEFAULT_WORKERS,
+                inference_mode : bool = True,
+                pin_memory : bool = None,
+                prefetch_factor : int = 2,
+                refine_max_pixels : int = MAX_PIXELS):
+        """
+        Batched inference engine around U2NET.
+        net: loaded U2NET (see u2_loader)
+        batch_size: number of images per forward pass
+        num_workers: number of DataLoader workers
+        inference_mode: run under torch.inference_mode
+            when True, torch.no_grad otherwise
+        pin_memory, prefetch_factor: see dataloader
+        refine_max_pixels: working resolution budget of the
+            CascadePSP refinement, see refine_stage.refine_mask
+        """
+        self.net = net
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.pin_memory = pin_memory
+        self.prefetch_factor = prefetch_factor
+        self.refine_max_pixels = refine_max_pixels
+        # Seconds spent in every stage of the last run
+        self.stage_seconds = {}
+        self.inference_mode = inference_mode
+        # int8 models have no parameters and run on the cpu
+        parameter = next(net.parameters(), None)
+        self.device = parameter.device if parameter is not None \
+                    else torch.device('cpu')
+        self.images_per_sec = 0.0
+
+    def _grad_context(self):
+        if self.inference_mode:
+            return _INFERENCE_MODE()
+        return torch.no_grad()
+
+    def predict(self, inputs):
+        """
+        Runs a batch through the network and returns the
+        normalized fused d0 predictions as a (N, H, W) numpy
+        array. Only d0 is returned when the network has the
+        output-only forward path.
+        """
+        inputs = inputs.to(self.device, dtype=torch.float32,
+                        non_blocking=True)
+        with self._grad_context():
+            if hasattr(self.net, 'forward_mask'):
+                d0 = self.net.forward_mask(inputs)
+            else:
+                d0 = self.net(inputs)[0]
+            pred = normPRED_batch(d0[:,0,:,:])
+        return pred.cpu().numpy()
+
+    def run(self, source_folder : str,
+            target_folder : str,
+            mask_folder : str,
+            refiner=None):
+        """
+        Extracts the foregrounds of every image in
+        source_folder, see extract_foregrounds_U2.
+        Output: number of images processed
+        """
+        img_name_list = glob.glob(source_folder + os.sep + '*')
+        return self.run_items([(img_name, target_folder, mask_folder)
+                            for img_name in img_name_list],
+                            refiner=refiner)
+
+    def run_items(self, items : list,
+                refiner=None):
+        """
+        Extracts the foregrounds of a list of images that
+        may belong to different classes. All images go through
+        one DataLoader, so the batches are filled across classes,
+        and every output is routed to the folders of its image.
+        With a refiner the masks are refined and saved by a
+        RefineStage, while U2Net runs on the next batches.
+        items: list of (image path, target folder, mask folder)
+        Output: number of images processed
+        """
+        # Get the images in one Dataloader
+        img_name_list = [img_name for img_name, _, _ in items]
+        tsds, tsdl, _ = image_loader(img_name_list,
+                                    batch_size=self.batch_size,
+                                    num_workers=self.num_workers,
+                                    pin_memory=self.pin_memory,
+                                    prefetch_factor=self.prefetch_factor)
+        # tsds = test salient data set
+        # tsdl = test salient data loader
+        # One allocator per mask folder
+        allocators = {}
+        stage = None
+        if refiner is not None:
+            stage = RefineStage(refiner, save_extractedfg_and_mask,
+                            max_pixels=self.refine_max_pixels)
+        # output is the saving, or the handing over to the
+        # refine stage which blocks while the stage is behind
+        seconds = {'decode': 0.0, 'u2net': 0.0, 'output': 0.0}
+        processed = 0
+        start = time.perf_counter()
+        tick = start
+        try:
+            for data_test in tqdm(tsdl):
+                # Time spent waiting for the DataLoader workers
+                seconds['decode'] += time.perf_counter() - tick
+                tick = time.perf_counter()
+                preds = self.predict(data_test['image'])
+                seconds['u2net'] += time.perf_counter() - tick
+                tick = time.perf_counter()
+                indices = data_test['imidx'][:,0].tolist()
+
+                # Originals decoded by the workers
+                for idx, image, pred in zip(indices,
+                                            data_test['original'],
+                                            preds):
+                    _, target_folder, mask_folder = items[idx]
+                    if mask_folder not in allocators:
+                        allocators[mask_folder] = fldr_chk.IndexAllocator(mask_folder,
+                                                                        'png')
+                    allocator = allocators[mask_folder]
+
+                    # Making mask from prediction
+                    mask = (pred*255).astype(np.uint8)
+                    mask = cv2.resize(mask,(image.shape[1],
+                                        image.shape[0]))
+
+                    # Saving the extracted foreground and mask
+                    number = str(allocator.next())
+                    fg_path = os.path.join(target_folder,number)
+                    mask_path = os.path.join(mask_folder, number)
+                    mask_path = f'{mask_path}.png'
+                    fg_path = f'{fg_path}.png'
+                    if stage is not None:
+                        # Cleaning up mask on the refine stage
+                        stage.submit(image, mask, fg_path, mask_path)
+                    else:
+                        save_extractedfg_and_mask(image, mask,
+                                                fg_path,
+                                                mask_path)
+                    processed += 1
+                seconds['output'] += time.perf_counter() - tick
+                tick = time.perf_counter()
+        finally:
+            # Unused numbers are given back even if the run fails
+            for allocator in allocators.values():
+                allocator.close()
+        if stage is not None:
+            # Time the refine stage still needs after U2Net
+            tick = time.perf_counter()
+            stage.close()
+            seconds['refine wait'] = time.perf_counter() - tick
+            seconds['refine'] = stage.refine_seconds
+            seconds['save'] = stage.save_seconds
+        elapsed = time.perf_counter() - start
+        if elapsed > 0:
+            self.images_per_sec = processed/elapsed
+        self.stage_seconds = seconds
+        print(f"U2Net processed {processed} images in {elapsed:.1f}s "
+              f"({self.images_per_sec:.2f} images/sec)")
+        print("Stage times: " + ", ".join(f"{name} {value:.1f}s"
+                                        for name, value in seconds.items()))
+        return processed
+
 def extract_foregrounds_U2(source_folder : str,
                             target_folder : str,
                             mask_folder : str,
-                            clean_up_post : bool):
+                            clean_up_post : bool,
+                            batch_size : int = 8,
+                            num_workers : int = DEFAULT_WORKERS,
+                            inference_mode : bool = True,
+                            session : ModelSession = None):
     """
     Extracting foregrounds from source folder
     and saving them as .png files in target 
@@ -79,64 +420,47 @@ def extract_foregrounds_U2(source_folder : str,
     masks prepared by the U2Net.
     Recommended to have hardware acceleration
     when using this
+    batch_size, num_workers, inference_mode: 
+    settings for the U2Engine
+    session: ModelSession holding the loaded networks,
+    pass one in to reuse the networks across calls.
+    A new session is created when None
+    """
+    img_name_list = glob.glob(source_folder + os.sep + '*')
+    return extract_items_U2([(img_name, target_folder, mask_folder)
+                            for img_name in img_name_list],
+                            clean_up_post,
+                            batch_size=batch_size,
+                            num_workers=num_workers,
+                            inference_mode=inference_mode,
+                            session=session)
+
+def extract_items_U2(items : list,
+                    clean_up_post : bool,
+                    batch_size : int = 8,
+                    num_workers : int = DEFAULT_WORKERS,
+                    inference_mode : bool = True,
+                    session : ModelSession = None):
+    """
+    Extracting foregrounds from images of several
+    classes in one stream, see U2Engine.run_items.
+    Inputs =
+    items: list of (image path, target folder,
+    mask folder)
+    Other inputs: see extract_foregrounds_U2
     """
+    if session is None:
+        session = ModelSession()
+
+    refiner = None
     if clean_up_post:
-        if torch.cuda.is_available():
-            refiner = refine.Refiner(device='cuda:0')
-        else:
-            refiner = refine.Refiner(device='cpu')
-
-    model_dir = './model/saved_models/u2net.pth'
-    model_state = 'empty'
-    if model_state == 'empty':
-        net, model_state = u2_loader(model_dir)
-    
-    # Get subfolder in Dataloader
-    tsds, tsdl, img_name_list = dataloader(source_folder)
-    # tsds = test salient data set
-    # tsdl = test salient data loader
-    for i_test, data_test in tqdm(enumerate(tsdl)):
-        inputs_test = data_test['image']
-        inputs_test = inputs_test.type(torch.FloatTensor)
-
-        if torch.cuda.is_available():
-            inputs_test = Variable(inputs_test.cuda())
-        else:
-            inputs_test = Variable(inputs_test)
-        
-        d1, d2, d3, d4, d5, d6, d7 = net(inputs_test)
-
-        # Normalization
-        pred = d1[:,0,:,:]
-        pred = normPRED(pred)
-
-        # Making mask from prediction
-        image_name = img_name_list[i_test]
-        predict = pred.squeeze()
-        predict_np = predict.cpu().data.numpy()
-        mask = Image.fromarray(predict_np*255).convert('RGB')
-        mask = cv2.cvtColor(np.array(mask), cv2.COLOR_BGR2GRAY)
-        image = cv2.imread(image_name)
-        mask = cv2.resize(mask,(image.shape[1],
-                            image.shape[0]))
-        del d1,d2, d3, d4, d5, d6, d7
-
-        # Cleaning up mask
-        if clean_up_post:
-            mask = post_process_mask(refine_net=refiner,
-                        image=image,
-                        mask=mask)
-
-        # Saving the extracted foreground and mask
-        number = str(fldr_chk.get_num(target_folder=mask_folder,
-                                extension='png'))
-        fg_path = os.path.join(target_folder,number)
-        mask_path = os.path.join(mask_folder, number)
-        mask_path = f'{mask_path}.png'
-        fg_path = f'{fg_path}.png'
-        save_extractedfg_and_mask(image, mask,
-                                fg_path,
-                                mask_path)
+        refiner = session.refiner
+
+    engine = U2Engine(session.u2net,
+                    batch_size=batch_size,
+                    num_workers=num_workers,
+                    inference_mode=inference_mode)
+    return engine.run_items(items, refiner=refiner)
 
 def save_extractedfg_and_mask(image,
                                 mask,
@@ -144,39 +468,32 @@ def save_extractedfg_and_mask(image,
                                 mask_path):
     """
     Saves the extracted foreground and mask as
-    png files
+    png files, cropped to the bounding box of the
+    mask. The crop is kept in the png, see
+    cutout.crop_offset
     Input: 
-    image: image to save 
+    image: BGR image to save, as read by cv2
     mask : mask to save
-    number: number will be used as the name
-    to save the image and mask 
+    fg_path, mask_path: paths of the foreground
+    and the mask
     """
-    # Saving the mask
-    cv2.imwrite(mask_path, mask)
-    # Extracting foreground with mask and image
-    image = Image.fromarray(image)
-    mask = Image.fromarray(mask)
-    image.putalpha(mask)
-    image.save(fg_path)
+    cutout.save_cutout(cv2.cvtColor(image, cv2.COLOR_BGR2RGB),
+                    mask, fg_path, mask_path)
 
 def post_process_mask(refine_net: Refiner,
                         image,
                         mask):
     """
     Function for post processing with the PSPCascade
-    mask refinement network
+    mask refinement network. Images larger than
+    MAX_PIXELS are refined downscaled, like on the
+    RefineStage that the extraction uses
     Inputs:
     refiner: refinement network
     image: image corresponding to mask
     mask: the mask that needs to be cleaned up
     fast
     """
-    output_mask = refine_net(image, mask,
-                            fast=True,
-                            L=900)
-
-    # Binarizing the image to avoid gray areas
-    ret, mask = cv2.threshold(output_mask,
-                            210, 255,
-                            cv2.THRESH_BINARY)
-    return mask
\ No newline at end of file
+    return refine_mask(refine_net, image, mask,
+                    max_pixels=MAX_PIXELS,
+                    L=900, fast=True)
\ No newline at end of file
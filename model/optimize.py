@@ -0,0 +1,149 @@
+import copy
+import torch
+import torch.nn as nn
+
+from .u2net import REBNCONV
+
+## jit modes of optimize_u2net
+JIT_MODES = (None,'trace','compile')
+
+## the optimized masks may differ from the reference by this much
+MAX_MEAN_ERROR = 0.02
+MIN_IOU = 0.98
+
+def fold_batchnorm(net):
+    ## folds the batchnorm of every REBNCONV into its conv, in place
+    for module in net.modules():
+        if isinstance(module,REBNCONV):
+            module.fuse_bn()
+    return net
+
+def _autocast(device_type):
+    ## bfloat16 autocast, torch.autocast only exists from torch 1.10 onwards
+    if not hasattr(torch,'autocast'):
+        raise RuntimeError("bfloat16 autocast needs torch 1.10 or newer")
+    return torch.autocast(device_type=device_type,dtype=torch.bfloat16)
+
+class OptimizedU2(nn.Module):
+    ## inference wrapper around U2NET/U2NETP that feeds channels last
+    ## inputs, runs under bfloat16 autocast and calls a traced or
+    ## compiled forward_mask. Build it with optimize_u2net
+
+    def __init__(self,net,channels_last=True,bf16=False,forward_mask_fn=None):
+        super(OptimizedU2,self).__init__()
+
+        self.net = net
+        self.channels_last = channels_last
+        self.bf16 = bf16
+        self._forward_mask = forward_mask_fn or net.forward_mask
+
+    def _prepare(self,x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return x
+
+    def forward(self,x):
+        x = self._prepare(x)
+        if self.bf16:
+            with _autocast(x.device.type):
+                return tuple(d.float() for d in self.net(x))
+        return self.net(x)
+
+    def forward_mask(self,x):
+        x = self._prepare(x)
+        if self.bf16:
+            with _autocast(x.device.type):
+                return self._forward_mask(x).float()
+        return self._forward_mask(x)
+
+def optimize_u2net(net,fold_bn=True,channels_last=True,bf16=False,jit=None,example_input=None):
+    """
+    Optimized inference mode of a loaded U2NET or U2NETP in eval mode.
+    The network is changed in place, keep a copy for a reference.
+    fold_bn: fold the batchnorms into the convs of REBNCONV
+    channels_last: run the convs in the channels last memory format
+    bf16: run under bfloat16 autocast, needs torch 1.10
+    jit: None, 'trace' for a TorchScript trace of forward_mask or
+        'compile' for torch.compile, which needs torch 2.0
+    example_input: batch used for the trace, a 1x3x320x320 batch if
+        None. The trace fixes the height and width of the inputs to
+        those of example_input, the batch size may differ
+    Output: OptimizedU2 with forward and forward_mask
+    """
+    if jit not in JIT_MODES:
+        raise ValueError(f"jit should be one of {JIT_MODES}")
+    net.eval()
+    if fold_bn:
+        fold_batchnorm(net)
+    if channels_last:
+        net = net.to(memory_format=torch.channels_last)
+
+    forward_mask_fn = None
+    if jit == 'trace':
+        if example_input is None:
+            device = next(net.parameters()).device
+            example_input = torch.zeros(1,3,320,320,device=device)
+        if channels_last:
+            example_input = example_input.contiguous(memory_format=torch.channels_last)
+        with torch.no_grad():
+            if bf16:
+                with _autocast(example_input.device.type):
+                    traced = torch.jit.trace_module(net,{'forward_mask':example_input})
+            else:
+                traced = torch.jit.trace_module(net,{'forward_mask':example_input})
+        forward_mask_fn = traced.forward_mask
+    elif jit == 'compile':
+        if not hasattr(torch,'compile'):
+            raise RuntimeError("torch.compile needs torch 2.0 or newer")
+        forward_mask_fn = torch.compile(net.forward_mask)
+
+    return OptimizedU2(net,channels_last=channels_last,bf16=bf16,forward_mask_fn=forward_mask_fn)
+
+def _normalize(d):
+    ## per image min-max normalization, as done for the masks
+    flat = d.reshape(d.shape[0],-1)
+    ma = flat.max(dim=1)[0].view(-1,1,1,1)
+    mi = flat.min(dim=1)[0].view(-1,1,1,1)
+    return (d-mi)/(ma-mi+1e-8)
+
+def check_masks(reference,optimized,inputs,max_mean_error=MAX_MEAN_ERROR,min_iou=MIN_IOU):
+    """
+    Compares the normalized d0 masks of the optimized network with
+    the reference network on a batch.
+    Output: dict with the mean and max absolute error, the IoU of the
+    masks thresholded at 0.5 and 'ok' when they are within tolerance
+    """
+    with torch.no_grad():
+        expected = _normalize(reference.forward_mask(inputs).float())
+        actual = _normalize(optimized.forward_mask(inputs).float())
+    error = (expected-actual).abs()
+    expected_fg = expected > 0.5
+    actual_fg = actual > 0.5
+    union = (expected_fg | actual_fg).sum().item()
+    iou = (expected_fg & actual_fg).sum().item()/union if union else 1.0
+    mean_error = error.mean().item()
+    return {'mean_error':mean_error,
+            'max_error':error.max().item(),
+            'iou':iou,
+            'ok':mean_error <= max_mean_error and iou >= min_iou}
+
+def optimize_checked(net,inputs,**options):
+    """
+    optimize_u2net followed by check_masks against an unchanged copy
+    of the network. inputs is a list of normalized Nx3x320x320 batches
+    of real images, the first one is also used for the trace.
+    Output: the optimized network and the report of the worst batch,
+    the original network if the masks are not within tolerance
+    """
+    reference = copy.deepcopy(net).eval()
+    device = next(net.parameters()).device
+    inputs = [batch.to(device,dtype=torch.float32) for batch in inputs]
+    optimized = optimize_u2net(net,example_input=inputs[0],**options)
+    reports = [check_masks(reference,optimized,batch) for batch in inputs]
+    report = {'mean_error':max(r['mean_error'] for r in reports),
+              'max_error':max(r['max_error'] for r in reports),
+              'iou':min(r['iou'] for r in reports),
+              'ok':all(r['ok'] for r in reports)}
+    if not report['ok']:
+        return reference,report
+    return optimized,report
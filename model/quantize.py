@@ -0,0 +1,76 @@
+import os
+import torch
+import torch.nn as nn
+from torch.quantization import get_default_qconfig
+from torch.quantization.quantize_fx import prepare_fx, convert_fx
+
+## input size of the saved quantized model, the trace fixes it
+INPUT_SIZE = 320
+
+def quantized_engine():
+    ## fbgemm on x86, qnnpack on arm
+    engines = torch.backends.quantized.supported_engines
+    return 'fbgemm' if 'fbgemm' in engines else 'qnnpack'
+
+class _ForwardMask(nn.Module):
+    ## makes forward_mask the forward, torch.fx only traces forward
+
+    def __init__(self,net):
+        super(_ForwardMask,self).__init__()
+
+        self.net = net
+
+    def forward(self,x):
+        return self.net.forward_mask(x)
+
+class QuantizedU2(nn.Module):
+    ## int8 U2NETP/U2NET that only computes the fused d0 mask, on the cpu.
+    ## forward and forward_mask both return d0
+
+    def __init__(self,quantized):
+        super(QuantizedU2,self).__init__()
+
+        self.quantized = quantized
+
+    def forward(self,x):
+        return self.quantized(x)
+
+    def forward_mask(self,x):
+        return self.quantized(x)
+
+def quantize_static(net,calibration_batches):
+    """
+    Post training static quantization of U2NET/U2NETP with torch.fx.
+    The conv, batchnorm and relu of every REBNCONV are fused and run
+    in int8. Dynamic quantization only covers Linear and LSTM layers,
+    so it would leave this all conv network in float.
+    net: float network in eval mode
+    calibration_batches: iterable of Nx3x320x320 float batches, the
+        activation ranges are observed on them
+    Output: traced QuantizedU2 on the cpu
+    """
+    engine = quantized_engine()
+    torch.backends.quantized.engine = engine
+    net = net.cpu().eval()
+
+    prepared = prepare_fx(_ForwardMask(net),{'':get_default_qconfig(engine)})
+    with torch.no_grad():
+        for batch in calibration_batches:
+            prepared(batch.float())
+    quantized = convert_fx(prepared)
+
+    ## traced so that it can be saved and loaded without the python code
+    example_input = torch.zeros(1,3,INPUT_SIZE,INPUT_SIZE)
+    with torch.no_grad():
+        traced = torch.jit.trace(quantized,example_input)
+    return QuantizedU2(traced)
+
+def save_quantized(model,path):
+    ## saves a QuantizedU2 as TorchScript
+    os.makedirs(os.path.dirname(path) or '.',exist_ok=True)
+    torch.jit.save(model.quantized,path)
+
+def load_quantized(path):
+    ## loads a QuantizedU2 saved with save_quantized
+    torch.backends.quantized.engine = quantized_engine()
+    return QuantizedU2(torch.jit.load(path,map_location='cpu'))
@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 from torchvision import models
 import torch.nn.functional as F
+import torch.fx
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 class REBNCONV(nn.Module):
     def __init__(self,in_ch=3,out_ch=3,dirate=1):
@@ -18,13 +20,22 @@ class REBNCONV(nn.Module):
 
         return xout
 
+    def fuse_bn(self):
+        ## fold the eval mode batchnorm into the conv, for inference only
+        self.conv_s1 = fuse_conv_bn_eval(self.conv_s1,self.bn_s1)
+        self.bn_s1 = nn.Identity()
+
 ## upsample tensor 'src' to have the same spatial size with tensor 'tar'
 def _upsample_like(src,tar):
 
-    src = F.upsample(src,size=tar.shape[2:],mode='bilinear')
+    src = F.interpolate(src,size=tar.shape[2:],mode='bilinear',align_corners=False)
 
     return src
 
+## keep the upsampling as a single call when the model is traced with torch.fx,
+## the size of 'tar' is only known at run time, see model/quantize.py
+torch.fx.wrap('_upsample_like')
+
 
 ### RSU-7 ###
 class RSU7(nn.Module):#UNet07DRES(nn.Module):
@@ -354,7 +365,7 @@ class U2NET(nn.Module):
 
         self.outconv = nn.Conv2d(6,out_ch,1)
 
-    def forward(self,x):
+    def _decode(self,x):
 
         hx = x
 
@@ -397,6 +408,11 @@ class U2NET(nn.Module):
 
         hx1d = self.stage1d(torch.cat((hx2dup,hx1),1))
 
+        return hx1d, hx2d, hx3d, hx4d, hx5d, hx6
+
+    def _side_outputs(self,x):
+
+        hx1d, hx2d, hx3d, hx4d, hx5d, hx6 = self._decode(x)
 
         #side output
         d1 = self.side1(hx1d)
@@ -418,7 +434,20 @@ class U2NET(nn.Module):
 
         d0 = self.outconv(torch.cat((d1,d2,d3,d4,d5,d6),1))
 
-        return F.sigmoid(d0), F.sigmoid(d1), F.sigmoid(d2), F.sigmoid(d3), F.sigmoid(d4), F.sigmoid(d5), F.sigmoid(d6)
+        return d0, d1, d2, d3, d4, d5, d6
+
+    def forward(self,x):
+
+        d0, d1, d2, d3, d4, d5, d6 = self._side_outputs(x)
+
+        return torch.sigmoid(d0), torch.sigmoid(d1), torch.sigmoid(d2), torch.sigmoid(d3), torch.sigmoid(d4), torch.sigmoid(d5), torch.sigmoid(d6)
+
+    def forward_mask(self,x):
+        # output-only path for inference: the mask is the fused output d0,
+        # the sigmoids of the side outputs d1-d6 are skipped
+        d0 = self._side_outputs(x)[0]
+
+        return torch.sigmoid(d0)
 
 ### U^2-Net small ###
 class U2NETP(nn.Module):
@@ -459,7 +488,7 @@ class U2NETP(nn.Module):
 
         self.outconv = nn.Conv2d(6,out_ch,1)
 
-    def forward(self,x):
+    def _decode(self,x):
 
         hx = x
 
@@ -502,6 +531,11 @@ class U2NETP(nn.Module):
 
         hx1d = self.stage1d(torch.cat((hx2dup,hx1),1))
 
+        return hx1d, hx2d, hx3d, hx4d, hx5d, hx6
+
+    def _side_outputs(self,x):
+
+        hx1d, hx2d, hx3d, hx4d, hx5d, hx6 = self._decode(x)
 
         #side output
         d1 = self.side1(hx1d)
@@ -523,4 +557,17 @@ class U2NETP(nn.Module):
 
         d0 = self.outconv(torch.cat((d1,d2,d3,d4,d5,d6),1))
 
-        return F.sigmoid(d0), F.sigmoid(d1), F.sigmoid(d2), F.sigmoid(d3), F.sigmoid(d4), F.sigmoid(d5), F.sigmoid(d6)
+        return d0, d1, d2, d3, d4, d5, d6
+
+    def forward(self,x):
+
+        d0, d1, d2, d3, d4, d5, d6 = self._side_outputs(x)
+
+        return torch.sigmoid(d0), torch.sigmoid(d1), torch.sigmoid(d2), torch.sigmoid(d3), torch.sigmoid(d4), torch.sigmoid(d5), torch.sigmoid(d6)
+
+    def forward_mask(self,x):
+        # output-only path for inference: the mask is the fused output d0,
+        # the sigmoids of the side outputs d1-d6 are skipped
+        d0 = self._side_outputs(x)[0]
+
+        return torch.sigmoid(d0)